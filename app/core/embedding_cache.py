@@ -0,0 +1,109 @@
+"""
+查询向量缓存模块，对相同（规范化后）的查询复用嵌入结果，避免重复调用嵌入API
+"""
+
+import re
+import logging
+import threading
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.embeddings import BaseEmbedding
+
+logger = logging.getLogger(__name__)
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_query(query: str) -> str:
+    """
+    规范化查询文本：去除首尾空白、合并连续空白并转为小写
+    
+    Args:
+        query: 查询文本
+        
+    Returns:
+        规范化后的查询文本
+    """
+    return _WHITESPACE_RE.sub(" ", query.strip().lower())
+
+
+class CachedEmbedding(BaseEmbedding):
+    """带LRU缓存的嵌入模型包装器，仅缓存查询向量，文档向量直接透传给底层模型"""
+    
+    _embed_model: BaseEmbedding = PrivateAttr()
+    _cache: "OrderedDict[str, Tuple[float, ...]]" = PrivateAttr()
+    _cache_size: int = PrivateAttr()
+    _lock: threading.Lock = PrivateAttr()
+    
+    def __init__(self, embed_model: BaseEmbedding, cache_size: int = 1024):
+        """
+        初始化缓存嵌入模型
+        
+        Args:
+            embed_model: 底层嵌入模型
+            cache_size: 缓存的查询数量上限
+        """
+        super().__init__(
+            model_name=embed_model.model_name,
+            embed_batch_size=embed_model.embed_batch_size,
+            callback_manager=embed_model.callback_manager,
+        )
+        self._embed_model = embed_model
+        self._cache = OrderedDict()
+        self._cache_size = cache_size
+        self._lock = threading.Lock()
+    
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedEmbedding"
+    
+    def _lookup(self, key: str) -> Optional[List[float]]:
+        """查找缓存，命中时将其标记为最近使用"""
+        with self._lock:
+            embedding = self._cache.get(key)
+            if embedding is not None:
+                self._cache.move_to_end(key)
+                return list(embedding)
+        return None
+    
+    def _store(self, key: str, embedding: List[float]) -> None:
+        """写入缓存，超出容量时淘汰最久未使用的条目"""
+        with self._lock:
+            self._cache[key] = tuple(embedding)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+    
+    def _get_query_embedding(self, query: str) -> List[float]:
+        key = normalize_query(query)
+        embedding = self._lookup(key)
+        if embedding is None:
+            embedding = self._embed_model.get_query_embedding(query)
+            self._store(key, embedding)
+        else:
+            logger.debug(f"查询向量缓存命中: {key}")
+        return embedding
+    
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        key = normalize_query(query)
+        embedding = self._lookup(key)
+        if embedding is None:
+            embedding = await self._embed_model.aget_query_embedding(query)
+            self._store(key, embedding)
+        else:
+            logger.debug(f"查询向量缓存命中: {key}")
+        return embedding
+    
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._embed_model.get_text_embedding(text)
+    
+    async def _aget_text_embedding(self, text: str) -> List[float]:
+        return await self._embed_model.aget_text_embedding(text)
+    
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return self._embed_model._get_text_embeddings(texts)
+    
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return await self._embed_model._aget_text_embeddings(texts)
@@ -4,35 +4,44 @@
 
 import logging
 import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Any, Optional
 
+import httpx
 from llama_index.core.schema import Document, BaseNode
-from llama_index.core import VectorStoreIndex, ServiceContext
+from llama_index.core import Settings
 from llama_index.embeddings.openai import OpenAIEmbedding
 from llama_index.llms.openai import OpenAI
 
 from app.document_processing.pdf_loader import PDFProcessor
-from app.database.pgvector_store import PGVectorManager
+from app.database.pgvector_store import PGVectorManager, COPY_BATCH_SIZE
 from app.core.retriever import RAGQueryEngine
-from app.utils.config import Config
+from app.utils.config import config
 
 logger = logging.getLogger(__name__)
 
+# 目录入库流水线中标记上游阶段结束的哨兵
+_PIPELINE_DONE = object()
+
 class KnowledgeBase:
     """PDF知识库管理类"""
     
     def __init__(self, 
                  table_name: str = "pdf_documents",
-                 rebuild: bool = False):
+                 rebuild: bool = False,
+                 http_client: Optional[httpx.Client] = None):
         """
         初始化知识库
         
         Args:
             table_name: 数据库表名
             rebuild: 是否重建知识库
+            http_client: 入库时计算嵌入使用的HTTP客户端，为None时自行创建
         """
         # 验证配置
-        Config.validate_config()
+        config.validate_config()
         
         self.table_name = table_name
         self.pdf_processor = PDFProcessor()
@@ -40,30 +49,41 @@ class KnowledgeBase:
         
         # 初始化OpenAI LLM
         self.llm = OpenAI(
-            api_key=Config.OPENAI_API_KEY,
-            model=Config.OPENAI_MODEL_NAME,
+            api_key=config.OPENAI_API_KEY,
+            model=config.OPENAI_MODEL_NAME,
             temperature=0.1
         )
         
         # 初始化OpenAI嵌入模型
         self.embedding_model = OpenAIEmbedding(
-            api_key=Config.OPENAI_API_KEY,
-            model=Config.OPENAI_EMBEDDING_MODEL_NAME,
-            embed_batch_size=10
+            api_key=config.OPENAI_API_KEY,
+            model=config.OPENAI_EMBEDDING_MODEL_NAME,
+            embed_batch_size=config.EMBED_BATCH_SIZE
         )
         
-        logger.info(f"使用OpenAI嵌入模型: {Config.OPENAI_EMBEDDING_MODEL_NAME}, 维度: {Config.OPENAI_EMBEDDING_MODEL_DIM}")
-        
-        # 创建服务上下文，指定使用的LLM和嵌入模型
-        self.service_context = ServiceContext.from_defaults(
-            llm=self.llm,
-            embed_model=self.embedding_model
+        # 入库专用的嵌入模型，只进行同步调用，可以复用外部传入的同步HTTP客户端；
+        # 查询走异步路径，AsyncOpenAI不能使用同步客户端，因此查询仍使用上面的嵌入模型
+        self.ingest_embedding_model = OpenAIEmbedding(
+            api_key=config.OPENAI_API_KEY,
+            model=config.OPENAI_EMBEDDING_MODEL_NAME,
+            embed_batch_size=config.EMBED_BATCH_SIZE,
+            http_client=http_client
         )
         
+        logger.info(f"使用OpenAI嵌入模型: {config.OPENAI_EMBEDDING_MODEL_NAME}, 维度: {config.OPENAI_EMBEDDING_MODEL_DIM}")
+        
+        # 全局设置使用的LLM和嵌入模型
+        Settings.llm = self.llm
+        Settings.embed_model = self.embedding_model
+        
         # 初始化索引和查询引擎
         self.index = None
         self.query_engine = None
         
+        # 进程内维护的文档（节点）数量
+        self._doc_count = 0
+        self._doc_count_lock = threading.Lock()
+        
         # 如果需要重建，清空现有数据
         if rebuild:
             self.clear_knowledge_base()
@@ -73,6 +93,9 @@ class KnowledgeBase:
         
         # 尝试加载现有索引
         self.index = self.pgvector_manager.get_index()
+        
+        # 启动时从数据库读取一次文档数量，之后随添加和清空在进程内更新
+        self._doc_count = self.pgvector_manager.get_document_count()
     
     def clear_knowledge_base(self) -> None:
         """清空知识库"""
@@ -80,6 +103,8 @@ class KnowledgeBase:
         self.pgvector_manager.clear_data()
         self.index = None
         self.query_engine = None
+        with self._doc_count_lock:
+            self._doc_count = 0
     
     def add_pdf_document(self, file_path: str) -> None:
         """
@@ -102,31 +127,238 @@ class KnowledgeBase:
             logger.error(f"添加PDF文档失败: {str(e)}")
             raise
     
+    def add_pdf_documents(self, file_paths: List[str]) -> List[str]:
+        """
+        批量添加多个PDF文档到知识库，所有文档的节点合并后一次性计算嵌入并写入
+        
+        Args:
+            file_paths: PDF文件路径列表
+            
+        Returns:
+            成功加载的文件路径列表
+        """
+        try:
+            logger.info(f"正在批量添加 {len(file_paths)} 个PDF文档")
+            
+            documents = []
+            loaded_paths = []
+            for file_path in file_paths:
+                try:
+                    documents.extend(self.pdf_processor.load_documents(file_path))
+                    loaded_paths.append(file_path)
+                except Exception as e:
+                    logger.error(f"加载PDF文档 {file_path} 失败: {str(e)}")
+                    continue
+            
+            if not documents:
+                logger.warning("没有成功加载任何PDF文档")
+                return []
+            
+            # 处理文档
+            self._process_and_index_documents(documents)
+            
+            logger.info(f"成功批量添加 {len(loaded_paths)} 个PDF文档")
+            return loaded_paths
+        except Exception as e:
+            logger.error(f"批量添加PDF文档失败: {str(e)}")
+            raise
+    
     def add_pdf_documents_from_dir(self, dir_path: str) -> None:
         """
-        从目录添加多个PDF文档到知识库
+        从目录（包括子目录）添加多个PDF文档到知识库
         
         Args:
             dir_path: 包含PDF文件的目录路径
         """
+        if not os.path.isdir(dir_path):
+            raise NotADirectoryError(f"目录不存在: {dir_path}")
+            
         try:
             logger.info(f"正在从目录添加PDF文档: {dir_path}")
             
-            # 加载目录中的所有文档
-            documents = self.pdf_processor.load_documents_from_dir(dir_path)
+            # 分阶段流水线处理目录中的文档：解析、嵌入、写入相互重叠
+            node_count = self._ingest_dir_pipeline(dir_path)
             
-            if not documents:
+            if not node_count:
                 logger.warning(f"目录 {dir_path} 中没有找到PDF文件")
                 return
             
-            # 处理文档
-            self._process_and_index_documents(documents)
+            with self._doc_count_lock:
+                self._doc_count += node_count
             
-            logger.info(f"成功从目录 {dir_path} 添加PDF文档")
+            # 初始化查询引擎
+            self._initialize_query_engine()
+            
+            logger.info(f"成功从目录 {dir_path} 添加PDF文档，共 {node_count} 个节点")
         except Exception as e:
             logger.error(f"从目录添加PDF文档失败: {str(e)}")
             raise
     
+    def _ingest_dir_pipeline(self, dir_path: str, parse_workers: int = 4, embed_batch: Optional[int] = None) -> int:
+        """
+        以流水线方式将目录中的PDF文档入库：扫描 → 解析分块 → 计算嵌入 → 写入
+        
+        各阶段在独立线程中运行，阶段之间使用有界队列连接，下游处理不过来时上游阻塞，内存占用保持稳定
+        
+        Args:
+            dir_path: 包含PDF文件的目录路径
+            parse_workers: 解析PDF的线程数
+            embed_batch: 每次提交给嵌入模型的节点数，默认使用EMBED_BATCH_SIZE
+            
+        Returns:
+            写入的节点数量
+        """
+        embed_batch = embed_batch or config.EMBED_BATCH_SIZE
+        
+        # 先扫描出全部文件，用于在首次写入前估算本次入库的总行数
+        paths = self._scan_pdf_paths(dir_path)
+        if not paths:
+            return 0
+        
+        path_q = queue.Queue(maxsize=2 * parse_workers)
+        node_q = queue.Queue(maxsize=16)
+        upsert_q = queue.Queue(maxsize=16)
+        errors = []
+        # 已解析的文件数和生成的节点数
+        parsed = {"files": 0, "nodes": 0}
+        parsed_lock = threading.Lock()
+        
+        def feed() -> None:
+            """将PDF文件路径放入path_q"""
+            try:
+                for path in paths:
+                    if errors:
+                        # 已有阶段失败，不再分发剩余的文件
+                        break
+                    path_q.put(path)
+            finally:
+                for _ in range(parse_workers):
+                    path_q.put(_PIPELINE_DONE)
+        
+        def parse() -> None:
+            """加载并分块PDF文件，将清理后的节点放入node_q"""
+            try:
+                while True:
+                    file_path = path_q.get()
+                    if file_path is _PIPELINE_DONE:
+                        break
+                    if errors:
+                        # 已有阶段失败，跳过剩余的文件，只消费队列直到结束
+                        continue
+                    nodes = []
+                    try:
+                        documents = self.pdf_processor.load_documents(file_path)
+                        nodes = self._clean_nodes(self.pdf_processor.process_documents(documents))
+                        if nodes:
+                            node_q.put(nodes)
+                    except Exception as e:
+                        logger.error(f"处理文件 {file_path} 时出错: {str(e)}")
+                    with parsed_lock:
+                        parsed["files"] += 1
+                        parsed["nodes"] += len(nodes)
+            finally:
+                node_q.put(_PIPELINE_DONE)
+        
+        def embed() -> None:
+            """汇集各解析线程的节点，凑满embed_batch后批量计算嵌入，放入upsert_q"""
+            finished = 0
+            batch = []
+            try:
+                while finished < parse_workers:
+                    nodes = node_q.get()
+                    if nodes is _PIPELINE_DONE:
+                        finished += 1
+                        continue
+                    if errors:
+                        # 已有阶段失败，只消费队列让上游退出
+                        continue
+                    batch.extend(nodes)
+                    while len(batch) >= embed_batch:
+                        chunk, batch = batch[:embed_batch], batch[embed_batch:]
+                        self.pgvector_manager.embed_nodes(chunk, self.ingest_embedding_model)
+                        upsert_q.put(chunk)
+                if batch and not errors:
+                    self.pgvector_manager.embed_nodes(batch, self.ingest_embedding_model)
+                    upsert_q.put(batch)
+            except Exception as e:
+                errors.append(e)
+                # 继续消费node_q，避免解析线程阻塞在put上
+                while finished < parse_workers:
+                    if node_q.get() is _PIPELINE_DONE:
+                        finished += 1
+            finally:
+                upsert_q.put(_PIPELINE_DONE)
+        
+        node_count = 0
+        defer_index = None
+        try:
+            with ThreadPoolExecutor(max_workers=parse_workers + 2) as executor:
+                executor.submit(feed)
+                for _ in range(parse_workers):
+                    executor.submit(parse)
+                executor.submit(embed)
+                
+                # 当前线程负责写入，累积到COPY_BATCH_SIZE后写入一次，减少写入和ANALYZE的次数
+                pending = []
+                while True:
+                    nodes = upsert_q.get()
+                    if nodes is not _PIPELINE_DONE and not errors:
+                        pending.extend(nodes)
+                    if pending and not errors and (nodes is _PIPELINE_DONE or len(pending) >= COPY_BATCH_SIZE):
+                        try:
+                            if defer_index is None:
+                                # 首次写入前，按已解析文件的平均节点数估算本次入库的总行数，决定是否延迟建索引
+                                with parsed_lock:
+                                    projected = parsed["nodes"] * len(paths) // max(parsed["files"], 1)
+                                defer_index = self.pgvector_manager.should_defer_index(projected)
+                                if defer_index:
+                                    self.pgvector_manager.drop_embedding_index()
+                            self.index = self.pgvector_manager.create_index_from_nodes(
+                                nodes=pending,
+                                embed_model=self.embedding_model
+                            )
+                            node_count += len(pending)
+                        except Exception as e:
+                            errors.append(e)
+                        pending = []
+                    if nodes is _PIPELINE_DONE:
+                        break
+        finally:
+            # 无论入库是否成功，都要重建被删除的向量索引；重建失败不能覆盖入库过程中的原始错误
+            if defer_index:
+                try:
+                    self.pgvector_manager.rebuild_embedding_index()
+                except Exception as e:
+                    logger.error(f"重建向量索引失败: {str(e)}")
+                    errors.append(e)
+        
+        if errors:
+            raise errors[0]
+        return node_count
+    
+    @staticmethod
+    def _scan_pdf_paths(dir_path: str) -> List[str]:
+        """
+        递归扫描目录及其子目录中的PDF文件
+        
+        Args:
+            dir_path: 目录路径
+            
+        Returns:
+            PDF文件路径列表
+        """
+        paths = []
+        # scandir返回的目录项自带文件类型，判断文件和目录时无需额外的stat调用
+        pending = [dir_path]
+        while pending:
+            with os.scandir(pending.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(entry.path)
+                    elif entry.is_file() and entry.name.lower().endswith('.pdf'):
+                        paths.append(entry.path)
+        return paths
+    
     def _process_and_index_documents(self, documents: List[Document]) -> None:
         """
         处理文档并建立索引
@@ -141,7 +373,30 @@ class KnowledgeBase:
             logger.warning("没有生成任何文档节点，跳过索引创建")
             return
             
-        # 清理节点元数据，确保没有'None'字符串或其他可能导致类型转换错误的值
+        cleaned_nodes = self._clean_nodes(nodes)
+        self.pgvector_manager.embed_nodes(cleaned_nodes, self.ingest_embedding_model)
+        
+        # 创建或更新索引
+        self.index = self.pgvector_manager.create_index_from_nodes(
+            nodes=cleaned_nodes,
+            embed_model=self.embedding_model
+        )
+        with self._doc_count_lock:
+            self._doc_count += len(cleaned_nodes)
+        
+        # 初始化查询引擎
+        self._initialize_query_engine()
+    
+    def _clean_nodes(self, nodes: List[BaseNode]) -> List[BaseNode]:
+        """
+        清理节点元数据，确保没有'None'字符串或其他可能导致类型转换错误的值
+        
+        Args:
+            nodes: 文档节点列表
+            
+        Returns:
+            清理后的节点列表
+        """
         cleaned_nodes = []
         for node in nodes:
             if node.metadata:
@@ -173,15 +428,7 @@ class KnowledgeBase:
             cleaned_nodes.append(node)
             
         logger.info(f"清理后的节点数量: {len(cleaned_nodes)}")
-        
-        # 创建或更新索引，显式传递服务上下文
-        self.index = self.pgvector_manager.create_index_from_nodes(
-            nodes=cleaned_nodes,
-            service_context=self.service_context
-        )
-        
-        # 初始化查询引擎
-        self._initialize_query_engine()
+        return cleaned_nodes
     
     def _initialize_query_engine(self) -> None:
         """初始化查询引擎"""
@@ -193,7 +440,7 @@ class KnowledgeBase:
             vector_index=self.index,
             llm=self.llm,
             embed_model=self.embedding_model,
-            service_context=self.service_context
+            index_params=self.pgvector_manager.get_query_params()
         )
         
         logger.info("查询引擎初始化完成")
@@ -216,6 +463,15 @@ class KnowledgeBase:
         # 执行查询
         return self.query_engine.query(query_str)
     
+    def fast_count(self) -> int:
+        """
+        获取进程内维护的文档数量，不访问数据库
+        
+        Returns:
+            文档数量
+        """
+        return self._doc_count
+    
     def get_status(self) -> Dict[str, Any]:
         """
         获取知识库状态
@@ -230,7 +486,7 @@ class KnowledgeBase:
             "initialized": self.index is not None,
             "document_count": doc_count,
             "table_name": self.table_name,
-            "embedding_model": Config.OPENAI_EMBEDDING_MODEL_NAME,
-            "embedding_dim": Config.OPENAI_EMBEDDING_MODEL_DIM,
-            "llm_model": Config.OPENAI_MODEL_NAME
+            "embedding_model": config.OPENAI_EMBEDDING_MODEL_NAME,
+            "embedding_dim": config.OPENAI_EMBEDDING_MODEL_DIM,
+            "llm_model": config.OPENAI_MODEL_NAME
         } 
\ No newline at end of file
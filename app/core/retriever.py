@@ -1,19 +1,204 @@
 """
-检索引擎模块，简化实现，使用PGVectorStore内置的混合检索功能
+检索引擎模块，混合检索在应用层对向量检索和BM25检索的结果做RRF融合
 """
 
+import asyncio
+import heapq
+import json
 import logging
-from typing import Dict, Any, Optional, List
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, Optional, List, Coroutine, Tuple
 
-from llama_index.core import VectorStoreIndex, ServiceContext
-from llama_index.core.schema import NodeWithScore, Node
-from llama_index.core.postprocessor import SimilarityPostprocessor
+from llama_index.core import Settings, VectorStoreIndex
+from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.query_engine import RetrieverQueryEngine
+from llama_index.core.schema import NodeWithScore, QueryBundle, MetadataMode
 from llama_index.core.llms import LLM
 from llama_index.core.embeddings import BaseEmbedding
-from llama_index.core.vector_stores.types import MetadataFilters, ExactMatchFilter, MetadataFilter
+from llama_index.core.vector_stores.types import MetadataFilters
+
+from app.core.embedding_cache import CachedEmbedding
+from app.utils.config import config
 
 logger = logging.getLogger(__name__)
 
+# 按过滤条件缓存的查询引擎数量上限，不含无过滤条件的默认引擎
+QUERY_ENGINE_CACHE_SIZE = 32
+
+# 后台事件循环，供同步的query()提交协程；
+# PGVectorStore的异步引擎（asyncpg连接池）绑定在首次使用的事件循环上，因此所有查询共用同一个循环
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_lock = threading.Lock()
+
+
+def _run_async(coro: Coroutine) -> Any:
+    """
+    在后台事件循环中运行协程并等待结果
+    
+    Args:
+        coro: 要运行的协程
+        
+    Returns:
+        协程的返回值
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="rag-query-loop", daemon=True).start()
+    return asyncio.run_coroutine_threadsafe(coro, _loop).result()
+
+
+def rrf_fuse(ranked_ids: List[List[str]], k: int = 60, top_k: int = 10) -> List[Tuple[str, float]]:
+    """
+    对多路排序结果做RRF融合: score(d) = Σ 1/(k + rank_i(d))
+    
+    Args:
+        ranked_ids: 各路检索结果的节点ID，按排名先后排列
+        k: RRF平滑常数
+        top_k: 返回的结果数量
+        
+    Returns:
+        按融合分数降序排列的(节点ID, 分数)列表
+    """
+    # 各名次的权重只与名次有关，预先算好避免在循环中重复做除法
+    max_len = max((len(ids) for ids in ranked_ids), default=0)
+    weights = [1.0 / (k + rank) for rank in range(1, max_len + 1)]
+    
+    scores: Dict[str, float] = {}
+    get = scores.get
+    for ids in ranked_ids:
+        for node_id, weight in zip(ids, weights):
+            scores[node_id] = get(node_id, 0.0) + weight
+    
+    return heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+
+
+# 引用中保留的元数据字段，其余字段（如文件路径等）不返回给前端
+CITATION_METADATA_KEYS = ("file_name", "page_label")
+
+
+def _citation_metadata(metadata: Dict[str, Any]) -> Dict[str, Any]:
+    """只保留引用展示所需的元数据字段"""
+    return {key: metadata[key] for key in CITATION_METADATA_KEYS if key in metadata}
+
+
+def _build_result(response: str, nodes: Optional[List[NodeWithScore]] = None, error: bool = False) -> Dict[str, Any]:
+    """
+    构建查询结果，引用信息按列存放（contents/scores/metadatas三个等长列表）
+    
+    Args:
+        response: 回答文本
+        nodes: 引用的节点
+        error: 查询过程中是否出错，出错时response为提示信息
+        
+    Returns:
+        包含回答和引用的字典
+    """
+    contents, scores, metadatas = (), (), ()
+    if nodes:
+        max_chars = config.CITATION_MAX_CHARS
+        contents, scores, metadatas = zip(*(
+            (
+                n.node.get_content(MetadataMode.NONE)[:max_chars],
+                n.score,
+                _citation_metadata(n.node.metadata),
+            )
+            for n in nodes
+        ))
+    return {
+        "response": response,
+        "error": error,
+        "contents": list(contents),
+        "scores": list(scores),
+        "metadatas": list(metadatas),
+    }
+
+
+class FusedNodeWithScore(NodeWithScore):
+    """RRF融合后的节点，score为融合分数，dense_score保留向量检索的相似度（只被BM25检索命中时为None）"""
+    
+    dense_score: Optional[float] = None
+
+
+class FusionRetriever(BaseRetriever):
+    """融合检索器，使用倒数排名融合（RRF）合并向量检索和BM25检索的结果"""
+    
+    def __init__(
+        self,
+        dense_retriever: BaseRetriever,
+        sparse_retriever: BaseRetriever,
+        rrf_k: int = 60,
+        top_k: int = 10,
+        embed_model: Optional[BaseEmbedding] = None,
+    ):
+        """
+        初始化融合检索器
+        
+        Args:
+            dense_retriever: 向量检索器
+            sparse_retriever: BM25（全文）检索器
+            rrf_k: RRF公式中的平滑常数k
+            top_k: 融合后保留的结果数量
+            embed_model: 嵌入模型，异步检索时先统一计算查询向量再并发执行两路检索
+        """
+        self.dense_retriever = dense_retriever
+        self.sparse_retriever = sparse_retriever
+        self.rrf_k = rrf_k
+        self.top_k = top_k
+        self.embed_model = embed_model
+        super().__init__()
+    
+    def _fuse(self, dense_nodes: List[NodeWithScore], sparse_nodes: List[NodeWithScore]) -> List[NodeWithScore]:
+        """
+        使用RRF融合两路排序结果: score(d) = Σ 1/(k + rank_i(d))
+        
+        Args:
+            dense_nodes: 向量检索按相似度降序排列的结果
+            sparse_nodes: BM25检索按分数降序排列的结果
+            
+        Returns:
+            按融合分数降序排列的前top_k个节点，同时保留向量检索的相似度
+        """
+        nodes_by_id: Dict[str, NodeWithScore] = {}
+        ranked_ids = []
+        for ranked in (dense_nodes, sparse_nodes):
+            ids = [node.node.node_id for node in ranked]
+            for node_id, node in zip(ids, ranked):
+                nodes_by_id.setdefault(node_id, node)
+            ranked_ids.append(ids)
+        dense_scores = {node.node.node_id: node.score for node in dense_nodes}
+        
+        fused = rrf_fuse(ranked_ids, k=self.rrf_k, top_k=self.top_k)
+        return [
+            FusedNodeWithScore(node=nodes_by_id[node_id].node, score=score, dense_score=dense_scores.get(node_id))
+            for node_id, score in fused
+        ]
+    
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        # 向量检索会把查询向量写入query_bundle，BM25检索复用同一个对象，避免重复嵌入
+        dense_nodes = self.dense_retriever.retrieve(query_bundle)
+        sparse_nodes = self.sparse_retriever.retrieve(query_bundle)
+        
+        logger.info(f"向量检索返回 {len(dense_nodes)} 个节点，BM25检索返回 {len(sparse_nodes)} 个节点")
+        return self._fuse(dense_nodes, sparse_nodes)
+    
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        # 先计算查询向量，两路检索共享，然后并发执行两次数据库查询
+        if self.embed_model is not None and query_bundle.embedding is None and query_bundle.embedding_strs:
+            query_bundle.embedding = await self.embed_model.aget_agg_embedding_from_queries(
+                query_bundle.embedding_strs
+            )
+        dense_nodes, sparse_nodes = await asyncio.gather(
+            self.dense_retriever.aretrieve(query_bundle),
+            self.sparse_retriever.aretrieve(query_bundle),
+        )
+        
+        logger.info(f"向量检索返回 {len(dense_nodes)} 个节点，BM25检索返回 {len(sparse_nodes)} 个节点")
+        return self._fuse(dense_nodes, sparse_nodes)
+
+
 class RAGQueryEngine:
     """RAG查询引擎，负责处理用户查询并生成回答"""
     
@@ -22,11 +207,13 @@ class RAGQueryEngine:
         vector_index: VectorStoreIndex,
         llm: LLM,
         embed_model: BaseEmbedding,
-        service_context: Optional[ServiceContext] = None,
         similarity_top_k: int = 4,
         similarity_cutoff: float = 0.5,  # 降低相似度阈值，提高检索成功率
         vector_store_query_mode: str = "hybrid",
         pgvector_options: Optional[Dict[str, Any]] = None,
+        index_params: Optional[Dict[str, Any]] = None,
+        rrf_k: int = 60,
+        fusion_top_k: int = 10,
     ):
         """
         初始化RAG查询引擎
@@ -35,29 +222,41 @@ class RAGQueryEngine:
             vector_index: 向量索引
             llm: 大语言模型
             embed_model: 嵌入模型
-            service_context: 服务上下文
             similarity_top_k: 检索返回结果数量
-            similarity_cutoff: 相似度阈值，低于此值的结果将被过滤
-            vector_store_query_mode: 向量存储查询模式，可选值: "default", "hybrid", "sparse"
+            similarity_cutoff: 相似度阈值，低于此值的结果仍用于生成回答，但不作为引用返回
+            vector_store_query_mode: 向量存储查询模式，可选值: "default", "hybrid", "sparse"，
+                "hybrid"模式在应用层对向量检索和BM25检索结果做RRF融合
             pgvector_options: PostgreSQL向量存储特定的选项，如ivfflat_probes, hnsw_ef_search等
+            index_params: 根据语料规模调整的向量索引参数，其中的hnsw_ef_search或ivfflat_probes会在每次查询时设置
+            rrf_k: RRF融合的平滑常数
+            fusion_top_k: RRF融合后保留的结果数量
         """
         self.vector_index = vector_index
         self.llm = llm
+        # 全局设置LLM和嵌入模型，未显式传入模型的LlamaIndex组件都使用这里的设置
+        Settings.llm = llm
+        Settings.embed_model = embed_model
+        # 缓存查询向量，重复提问时不再调用嵌入API
+        if not isinstance(embed_model, CachedEmbedding):
+            embed_model = CachedEmbedding(embed_model, cache_size=config.QUERY_EMBED_CACHE_SIZE)
         self.embed_model = embed_model
-        self.service_context = service_context
         self.similarity_top_k = similarity_top_k
         self.similarity_cutoff = similarity_cutoff
         self.vector_store_query_mode = vector_store_query_mode
+        self.use_fusion = vector_store_query_mode == "hybrid"
         
         # 默认的PostgreSQL向量存储选项
         default_pgvector_options = {
             "ivfflat_probes": 20,  # 增加搜索探针数量以提高召回率
-            "hnsw_ef_search": 200,  # 增加搜索候选项以提高召回率
             "alpha": 0.75,  # hybrid搜索中向量搜索的权重
         }
         
-        # 合并用户提供的选项
-        self.pgvector_options = {**default_pgvector_options, **(pgvector_options or {})}
+        # 合并向量索引参数和用户提供的选项，用户选项优先
+        self.pgvector_options = {
+            **default_pgvector_options,
+            **(index_params or {}),
+            **(pgvector_options or {}),
+        }
         
         logger.info(f"使用向量存储查询模式: {vector_store_query_mode}")
         logger.info(f"PGVector选项: {self.pgvector_options}")
@@ -74,46 +273,121 @@ class RAGQueryEngine:
         except Exception as e:
             logger.warning(f"无法获取向量存储信息: {str(e)}")
         
-        # 直接使用vector_index.as_query_engine创建查询引擎
+        self.rrf_k = rrf_k
+        self.fusion_top_k = fusion_top_k
+        # 默认的元数据过滤条件，通过apply_filter设置
+        self.filters: Optional[MetadataFilters] = None
+        # 按过滤条件缓存的查询引擎（LRU），键为过滤条件的规范化JSON
+        self._query_engines: "OrderedDict[str, Any]" = OrderedDict()
+        self._query_engines_lock = threading.Lock()
+        
         try:
-            # 创建查询引擎，利用PGVectorStore内置的混合检索功能
             logger.info(f"创建查询引擎，使用{vector_store_query_mode}模式...")
-            
-            # 禁用SimilarityPostprocessor以获取更多结果
-            self.query_engine = vector_index.as_query_engine(
-                service_context=service_context,
-                similarity_top_k=similarity_top_k * 2,  # 检索更多结果，稍后手动过滤
-                vector_store_query_mode=vector_store_query_mode,
-                vector_store_kwargs=self.pgvector_options,
-            )
+            self.query_engine = self._build_query_engine()
             logger.info(f"成功创建查询引擎，使用{vector_store_query_mode}模式")
         except Exception as e:
             logger.error(f"创建查询引擎失败: {str(e)}")
             # 尝试回退到默认检索模式
             try:
                 logger.info("尝试使用默认检索模式创建查询引擎...")
-                self.query_engine = vector_index.as_query_engine(
-                    service_context=service_context,
-                    similarity_top_k=similarity_top_k,
-                )
+                self.use_fusion = False
+                self.vector_store_query_mode = "default"
+                self.query_engine = self._build_query_engine()
                 logger.info("成功使用默认检索模式创建查询引擎")
             except Exception as fallback_e:
                 logger.error(f"使用默认模式创建查询引擎也失败: {str(fallback_e)}")
                 raise
     
+    @staticmethod
+    def _filters_key(filters: MetadataFilters) -> str:
+        """将过滤条件转换为规范化的JSON字符串，作为查询引擎缓存的键"""
+        return json.dumps(filters.dict(), sort_keys=True, ensure_ascii=False, default=str)
+    
+    def _build_query_engine(self, filters: Optional[MetadataFilters] = None) -> Any:
+        """
+        创建查询引擎
+        
+        Args:
+            filters: 元数据过滤条件
+            
+        Returns:
+            查询引擎
+        """
+        if self.use_fusion:
+            # 两路分别检索，再用RRF融合；每路多取一些候选以提高融合后的召回率
+            dense_retriever = self.vector_index.as_retriever(
+                similarity_top_k=self.fusion_top_k * 2,
+                vector_store_query_mode="default",
+                vector_store_kwargs=self.pgvector_options,
+                embed_model=self.embed_model,
+                filters=filters,
+            )
+            sparse_retriever = self.vector_index.as_retriever(
+                similarity_top_k=self.fusion_top_k * 2,
+                vector_store_query_mode="sparse",
+                embed_model=self.embed_model,
+                filters=filters,
+            )
+            retriever = FusionRetriever(
+                dense_retriever=dense_retriever,
+                sparse_retriever=sparse_retriever,
+                rrf_k=self.rrf_k,
+                top_k=self.fusion_top_k,
+                embed_model=self.embed_model,
+            )
+            return RetrieverQueryEngine.from_args(
+                retriever=retriever,
+                llm=self.llm,
+            )
+        
+        # 不在检索阶段按相似度过滤，相似度阈值只用于在aquery中筛选引用
+        return self.vector_index.as_query_engine(
+            llm=self.llm,
+            similarity_top_k=self.similarity_top_k * 2,  # 检索更多结果，稍后手动过滤
+            vector_store_query_mode=self.vector_store_query_mode,
+            vector_store_kwargs=self.pgvector_options,
+            embed_model=self.embed_model,
+            filters=filters,
+        )
+    
+    def _get_query_engine(self, filters: Optional[MetadataFilters]) -> Any:
+        """
+        获取指定过滤条件对应的查询引擎，不存在时创建并缓存，超出容量时淘汰最久未使用的引擎
+        
+        Args:
+            filters: 元数据过滤条件
+            
+        Returns:
+            查询引擎
+        """
+        if filters is None:
+            return self.query_engine
+        
+        key = self._filters_key(filters)
+        with self._query_engines_lock:
+            query_engine = self._query_engines.get(key)
+            if query_engine is not None:
+                self._query_engines.move_to_end(key)
+                return query_engine
+        
+        logger.info(f"为过滤条件创建查询引擎: {filters}")
+        query_engine = self._build_query_engine(filters)
+        with self._query_engines_lock:
+            self._query_engines[key] = query_engine
+            self._query_engines.move_to_end(key)
+            while len(self._query_engines) > QUERY_ENGINE_CACHE_SIZE:
+                self._query_engines.popitem(last=False)
+        return query_engine
+    
     def apply_filter(self, metadata_filters: MetadataFilters) -> None:
         """
-        应用元数据过滤条件
+        应用元数据过滤条件，之后未指定过滤条件的查询都使用该条件
         
         Args:
             metadata_filters: 元数据过滤条件
         """
-        # 根据query_engine的具体实现更新过滤条件
-        if hasattr(self.query_engine, "retriever") and hasattr(self.query_engine.retriever, "filters"):
-            self.query_engine.retriever.filters = metadata_filters
-            logger.info(f"应用元数据过滤条件: {metadata_filters}")
-        else:
-            logger.warning("无法应用元数据过滤条件，查询引擎不支持此操作")
+        self.filters = metadata_filters
+        logger.info(f"应用元数据过滤条件: {metadata_filters}")
     
     def _format_debug_info(self, source_nodes: List[NodeWithScore]) -> str:
         """格式化调试信息，显示检索到的内容和分数"""
@@ -127,7 +401,20 @@ class RAGQueryEngine:
     
     def query(self, query_str: str, filters: Optional[MetadataFilters] = None) -> Dict[str, Any]:
         """
-        处理用户查询并生成回答
+        处理用户查询并生成回答（aquery的同步封装）
+        
+        Args:
+            query_str: 用户查询字符串
+            filters: 查询特定的元数据过滤条件
+            
+        Returns:
+            包含回答和引用的字典
+        """
+        return _run_async(self.aquery(query_str, filters))
+    
+    async def aquery(self, query_str: str, filters: Optional[MetadataFilters] = None) -> Dict[str, Any]:
+        """
+        异步处理用户查询并生成回答
         
         Args:
             query_str: 用户查询字符串
@@ -139,68 +426,52 @@ class RAGQueryEngine:
         try:
             logger.info(f"处理用户查询: {query_str}")
             
-            # 临时应用过滤条件（如果有）
-            original_filters = None
-            if filters and hasattr(self.query_engine, "retriever") and hasattr(self.query_engine.retriever, "filters"):
-                original_filters = self.query_engine.retriever.filters
-                self.query_engine.retriever.filters = filters
-                logger.info(f"应用临时过滤条件: {filters}")
+            # 每组过滤条件使用各自缓存的查询引擎，不修改共享引擎的状态
+            query_engine = self._get_query_engine(filters or self.filters)
             
             # 尝试直接查询
             try:
-                response = self.query_engine.query(query_str)
+                response = await query_engine.aquery(query_str)
                 logger.info("查询执行成功")
             except Exception as query_err:
                 logger.error(f"直接查询失败: {str(query_err)}，尝试备用方法")
                 
                 # 尝试备用方法：直接使用检索器
-                if hasattr(self.query_engine, "retriever"):
+                if hasattr(query_engine, "retriever"):
                     try:
                         logger.info("使用备用方法：直接调用检索器")
-                        retriever = self.query_engine.retriever
-                        nodes = retriever.retrieve(query_str)
+                        retriever = query_engine.retriever
+                        nodes = await retriever.aretrieve(query_str)
                         
                         if not nodes:
                             logger.warning("检索器未返回任何结果")
-                            return {
-                                "response": "对不起，我没有找到相关的信息。",
-                                "citations": [],
-                            }
+                            return _build_result("对不起，我没有找到相关的信息。", error=True)
                             
                         # 使用LLM生成回答
                         from llama_index.core.response_synthesizers import get_response_synthesizer
                         response_synthesizer = get_response_synthesizer(
-                            service_context=self.service_context,
+                            llm=self.llm,
                         )
-                        response = response_synthesizer.synthesize(
+                        response = await response_synthesizer.asynthesize(
                             query=query_str,
                             nodes=nodes,
                         )
                         logger.info("使用备用方法成功生成回答")
                     except Exception as retriever_err:
                         logger.error(f"使用检索器的备用方法也失败: {str(retriever_err)}")
-                        return {
-                            "response": "对不起，处理您的查询时出现了问题。",
-                            "citations": [],
-                        }
+                        return _build_result("对不起，处理您的查询时出现了问题。", error=True)
                 else:
-                    return {
-                        "response": "对不起，处理您的查询时出现了问题。",
-                        "citations": [],
-                    }
-            
-            # 恢复原始过滤条件
-            if filters and original_filters is not None and hasattr(self.query_engine, "retriever"):
-                self.query_engine.retriever.filters = original_filters
-                logger.info("恢复原始过滤条件")
+                    return _build_result("对不起，处理您的查询时出现了问题。", error=True)
             
             # 提取引用信息
             source_nodes = getattr(response, "source_nodes", [])
             
-            # 应用相似度过滤
+            # 按相似度阈值筛选引用，所有检索结果仍用于生成回答；
+            # RRF分数不是相似度，融合结果按向量检索的相似度筛选（只被BM25检索命中的节点没有相似度，予以保留）
             filtered_nodes = []
             for node in source_nodes:
-                if node.score is None or node.score >= self.similarity_cutoff:
+                score = getattr(node, "dense_score", None) if self.use_fusion else node.score
+                if score is None or score >= self.similarity_cutoff:
                     filtered_nodes.append(node)
             
             if filtered_nodes:
@@ -215,29 +486,13 @@ class RAGQueryEngine:
                 else:
                     logger.warning("未检索到任何内容")
             
-            # 格式化引用信息
-            formatted_citations = []
-            for i, node in enumerate(filtered_nodes):
-                citation = {
-                    "content": node.node.get_content(),
-                    "score": node.score,
-                    "metadata": node.node.metadata,
-                }
-                formatted_citations.append(citation)
-            
             # 检查是否有回答
             answer = str(response) if response else "无法生成回答，请尝试重新表述您的问题。"
             if answer.strip() == "":
                 answer = "对不起，我无法根据现有知识回答这个问题。"
                 logger.warning("生成的回答为空")
             
-            return {
-                "response": answer,
-                "citations": formatted_citations,
-            }
+            return _build_result(answer, filtered_nodes)
         except Exception as e:
             logger.error(f"查询处理失败: {str(e)}")
-            return {
-                "response": "处理查询时发生错误，请稍后再试。",
-                "citations": [],
-            } 
\ No newline at end of file
+            return _build_result("处理查询时发生错误，请稍后再试。", error=True) 
\ No newline at end of file
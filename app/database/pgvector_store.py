@@ -2,20 +2,383 @@
 PostgreSQL 向量存储模块，负责文档向量的存储和检索
 """
 
-from typing import List, Optional
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Union
+import io
+import json
 import logging
+import math
 import psycopg2
+import psycopg2.errors
+import psycopg2.pool
+from psycopg2 import sql
 
-from llama_index.core import StorageContext
+from llama_index.core import Settings, StorageContext
 from llama_index.vector_stores.postgres import PGVectorStore
+from llama_index.vector_stores.postgres.base import DBEmbeddingRow
+from llama_index.core.embeddings import BaseEmbedding
 from llama_index.core.schema import BaseNode, MetadataMode
+from llama_index.core.vector_stores.types import MetadataFilters
+from llama_index.core.vector_stores.utils import node_to_metadata_dict
 from llama_index.core import VectorStoreIndex
-from sqlalchemy import make_url
+from sqlalchemy import make_url, select, cast, text
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+from sqlalchemy.types import Float, UserDefinedType
 
-from app.utils.config import Config
+from app.utils.config import config
 
 logger = logging.getLogger(__name__)
 
+# 批量入库后语料规模超过该值时，先删除向量索引，全部写入完成后再一次性重建
+DEFER_INDEX_THRESHOLD = 1_000_000
+
+# 每次COPY写入的最大行数
+COPY_BATCH_SIZE = 10_000
+
+# 写入前批量计算嵌入时，每批提交给嵌入模型的节点数
+EMBED_CHUNK_SIZE = 1024
+
+# 元数据过滤条件的估算选择率低于该值时，先过滤再在候选行上计算距离，不走ANN索引
+FILTER_FIRST_SELECTIVITY = 0.01
+
+# 先ANN再过滤时，ANN阶段取回的候选数为limit的倍数
+FILTERED_FETCH_MULTIPLIER = 10
+
+
+def _vector_literal(values: List[float]) -> str:
+    """将向量格式化为pgvector的文本表示，如[0.1,0.2]"""
+    return "[" + ",".join(str(float(v)) for v in values) + "]"
+
+
+class ExplainJSON(Executable, ClauseElement):
+    """EXPLAIN (FORMAT JSON) 语句，内部语句由执行时的方言编译，参数和转义与直接执行该语句时一致"""
+    
+    inherit_cache = False
+    
+    def __init__(self, statement: Any):
+        self.statement = statement
+
+
+@compiles(ExplainJSON)
+def _compile_explain_json(element: ExplainJSON, compiler: Any, **kw: Any) -> str:
+    return "EXPLAIN (FORMAT JSON) " + compiler.process(element.statement, **kw)
+
+
+def _copy_escape(value: str) -> str:
+    """转义COPY文本格式中的特殊字符"""
+    return (
+        value.replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+class HalfVec(UserDefinedType):
+    """pgvector的halfvec类型（半精度向量），用于在查询中对向量参数进行类型转换"""
+
+    cache_ok = True
+
+    def __init__(self, dim: int):
+        self.dim = dim
+
+    def get_col_spec(self, **kw: Any) -> str:
+        return f"halfvec({self.dim})"
+
+    def bind_processor(self, dialect):
+        def process(value):
+            if value is None:
+                return None
+            return _vector_literal(value)
+        return process
+
+
+class HalfVecPGVectorStore(PGVectorStore):
+    """
+    使用halfvec列存储向量的PGVectorStore
+
+    embedding列为halfvec类型，查询向量同样转换为halfvec，
+    使其能够命中halfvec_cosine_ops的HNSW索引
+    """
+
+    def _build_query(
+        self,
+        embedding: Optional[List[float]],
+        limit: int = 10,
+        metadata_filters: Optional[MetadataFilters] = None,
+    ) -> Any:
+        query_vector = cast(embedding, HalfVec(self.embed_dim))
+        distance = self._table_class.embedding.op("<=>", return_type=Float)(query_vector)
+
+        stmt = select(
+            self._table_class.id,
+            self._table_class.node_id,
+            self._table_class.text,
+            self._table_class.metadata_,
+            distance.label("distance"),
+        ).order_by(text("distance asc"))
+
+        return self._apply_filters_and_limit(stmt, limit, metadata_filters)
+    
+    def _build_filtered_query(
+        self,
+        embedding: Optional[List[float]],
+        limit: int,
+        metadata_filters: MetadataFilters,
+        filter_first: bool,
+    ) -> Any:
+        """
+        构建带元数据过滤条件的向量查询
+        
+        Args:
+            embedding: 查询向量
+            limit: 返回结果数量
+            metadata_filters: 元数据过滤条件
+            filter_first: 为True时先在CTE中取出满足过滤条件的行，再在这些行上按距离精确排序；
+                为False时先用ANN索引取回limit*FILTERED_FETCH_MULTIPLIER个候选，再在候选上过滤
+                
+        Returns:
+            查询语句
+        """
+        where_clause = self._recursively_apply_filters(metadata_filters)
+        
+        if filter_first:
+            # MATERIALIZED防止规划器把CTE内联回ANN索引扫描
+            candidates = (
+                select(
+                    self._table_class.id,
+                    self._table_class.node_id,
+                    self._table_class.text,
+                    self._table_class.metadata_,
+                    self._table_class.embedding,
+                )
+                .where(where_clause)
+                .cte("filtered_candidates")
+                .prefix_with("MATERIALIZED")
+            )
+            query_vector = cast(embedding, HalfVec(self.embed_dim))
+            distance = candidates.c.embedding.op("<=>", return_type=Float)(query_vector)
+            return select(
+                candidates.c.id,
+                candidates.c.node_id,
+                candidates.c.text,
+                candidates.c.metadata_,
+                distance.label("distance"),
+            ).order_by(text("distance asc")).limit(limit)
+        
+        candidates = self._build_query(embedding, limit * FILTERED_FETCH_MULTIPLIER).subquery("ann_candidates")
+        return (
+            select(
+                candidates.c.id,
+                candidates.c.node_id,
+                candidates.c.text,
+                candidates.c.metadata_,
+                candidates.c.distance,
+            )
+            .where(where_clause)
+            .order_by(candidates.c.distance)
+            .limit(limit)
+        )
+    
+    def _filter_estimate_stmts(self, metadata_filters: MetadataFilters) -> Sequence[Any]:
+        """
+        生成估算过滤条件选择率所需的语句：过滤条件的规划器估算行数，以及表的总行数估算
+        
+        metadata_列为JSON类型，pg_stats中没有按键的统计信息，因此使用规划器的EXPLAIN估算
+        """
+        filter_stmt = select(self._table_class.id).where(
+            self._recursively_apply_filters(metadata_filters)
+        )
+        return (
+            ExplainJSON(filter_stmt),
+            text("SELECT reltuples FROM pg_class WHERE oid = to_regclass(:table_name)").bindparams(
+                table_name=f"{self.schema_name}.data_{self.table_name}"
+            ),
+        )
+    
+    @staticmethod
+    def _selectivity(plan: Any, reltuples: Optional[float]) -> float:
+        """根据EXPLAIN结果和表的估算总行数计算选择率，无法估算时按不具选择性处理"""
+        if not reltuples or reltuples <= 0:
+            return 1.0
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return plan[0]["Plan"]["Plan Rows"] / reltuples
+    
+    def _index_param_stmts(self, limit: int, filter_first: bool, **kwargs: Any) -> List[Any]:
+        """
+        生成查询前需要设置的索引参数语句
+        
+        先ANN再过滤时，HNSW最多返回ef_search个结果，因此ef_search至少要覆盖候选数
+        """
+        stmts = []
+        if kwargs.get("ivfflat_probes"):
+            stmts.append(text(f"SET ivfflat.probes = {int(kwargs['ivfflat_probes'])}"))
+        if not filter_first:
+            ef_search = max(int(kwargs.get("hnsw_ef_search") or 0), limit * FILTERED_FETCH_MULTIPLIER)
+            stmts.append(text(f"SET hnsw.ef_search = {ef_search}"))
+        return stmts
+    
+    @staticmethod
+    def _to_embedding_rows(rows: Sequence[Any]) -> List[DBEmbeddingRow]:
+        """将查询结果转换为DBEmbeddingRow"""
+        return [
+            DBEmbeddingRow(
+                node_id=item.node_id,
+                text=item.text,
+                metadata=item.metadata_,
+                similarity=(1 - item.distance) if item.distance is not None else 0,
+            )
+            for item in rows
+        ]
+    
+    def _query_with_score(
+        self,
+        embedding: Optional[List[float]],
+        limit: int = 10,
+        metadata_filters: Optional[MetadataFilters] = None,
+        **kwargs: Any,
+    ) -> List[DBEmbeddingRow]:
+        if not metadata_filters:
+            return super()._query_with_score(embedding, limit, metadata_filters, **kwargs)
+        
+        explain_stmt, reltuples_stmt = self._filter_estimate_stmts(metadata_filters)
+        with self._session() as session, session.begin():
+            selectivity = self._selectivity(
+                session.execute(explain_stmt).scalar(),
+                session.execute(reltuples_stmt).scalar(),
+            )
+            filter_first = selectivity < FILTER_FIRST_SELECTIVITY
+            logger.debug("过滤条件估算选择率: %.4f，%s", selectivity, "先过滤后计算距离" if filter_first else "先ANN后过滤")
+            
+            for stmt in self._index_param_stmts(limit, filter_first, **kwargs):
+                session.execute(stmt)
+            res = session.execute(
+                self._build_filtered_query(embedding, limit, metadata_filters, filter_first)
+            )
+            return self._to_embedding_rows(res.all())
+    
+    async def _aquery_with_score(
+        self,
+        embedding: Optional[List[float]],
+        limit: int = 10,
+        metadata_filters: Optional[MetadataFilters] = None,
+        **kwargs: Any,
+    ) -> List[DBEmbeddingRow]:
+        if not metadata_filters:
+            return await super()._aquery_with_score(embedding, limit, metadata_filters, **kwargs)
+        
+        explain_stmt, reltuples_stmt = self._filter_estimate_stmts(metadata_filters)
+        async with self._async_session() as async_session, async_session.begin():
+            selectivity = self._selectivity(
+                (await async_session.execute(explain_stmt)).scalar(),
+                (await async_session.execute(reltuples_stmt)).scalar(),
+            )
+            filter_first = selectivity < FILTER_FIRST_SELECTIVITY
+            logger.debug("过滤条件估算选择率: %.4f，%s", selectivity, "先过滤后计算距离" if filter_first else "先ANN后过滤")
+            
+            for stmt in self._index_param_stmts(limit, filter_first, **kwargs):
+                await async_session.execute(stmt)
+            res = await async_session.execute(
+                self._build_filtered_query(embedding, limit, metadata_filters, filter_first)
+            )
+            return self._to_embedding_rows(res.all())
+    
+    def _node_to_copy_row(self, node: BaseNode) -> str:
+        """将节点转换为COPY文本格式的一行（node_id, embedding, text, metadata_）"""
+        embedding = node.get_embedding()
+        metadata = node_to_metadata_dict(node, remove_text=True, flat_metadata=self.flat_metadata)
+        fields = [
+            _copy_escape(node.node_id) if node.node_id is not None else "\\N",
+            _vector_literal(embedding),
+            _copy_escape(node.get_content(metadata_mode=MetadataMode.NONE)),
+            _copy_escape(json.dumps(metadata, ensure_ascii=False)),
+        ]
+        return "\t".join(fields) + "\n"
+    
+    def add(self, nodes: List[BaseNode], **add_kwargs: Any) -> List[str]:
+        """
+        使用COPY批量写入节点，代替逐行INSERT
+        
+        Args:
+            nodes: 已计算嵌入向量的节点列表
+            
+        Returns:
+            写入的节点ID列表
+        """
+        self._initialize()
+        ids = []
+        table = f"{self.schema_name}.data_{self.table_name}"
+        copy_sql = sql.SQL("COPY {}.{} (node_id, embedding, text, metadata_) FROM STDIN").format(
+            sql.Identifier(self.schema_name), sql.Identifier(f"data_{self.table_name}")
+        )
+        
+        conn = self._engine.raw_connection()
+        try:
+            with conn.cursor() as cursor:
+                for start in range(0, len(nodes), COPY_BATCH_SIZE):
+                    buffer = io.StringIO()
+                    for node in nodes[start:start + COPY_BATCH_SIZE]:
+                        ids.append(node.node_id)
+                        buffer.write(self._node_to_copy_row(node))
+                    buffer.seek(0)
+                    cursor.copy_expert(copy_sql, buffer)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        
+        logger.info(f"通过COPY写入 {len(ids)} 个节点到表 {table}")
+        return ids
+
+
+def configure_hnsw_params(vector_count: int) -> Dict[str, int]:
+    """
+    根据向量数量选择HNSW索引参数
+    
+    Args:
+        vector_count: 表中的向量数量
+        
+    Returns:
+        包含hnsw_m、hnsw_ef_construction、hnsw_ef_search的字典
+    """
+    if vector_count < 100_000:
+        return {"hnsw_m": 16, "hnsw_ef_construction": 64, "hnsw_ef_search": 40}
+    if vector_count < 1_000_000:
+        return {"hnsw_m": 24, "hnsw_ef_construction": 100, "hnsw_ef_search": 100}
+    return {"hnsw_m": 32, "hnsw_ef_construction": 128, "hnsw_ef_search": 200}
+
+
+def configure_ivfflat_params(vector_count: int) -> Dict[str, int]:
+    """
+    根据向量数量选择IVFFlat索引参数，lists取√N（至少100），probes取√lists（至少10）
+    
+    Args:
+        vector_count: 表中的向量数量
+        
+    Returns:
+        包含ivfflat_lists、ivfflat_probes的字典
+    """
+    lists = max(100, int(math.sqrt(vector_count)))
+    return {"ivfflat_lists": lists, "ivfflat_probes": ivfflat_probes_for_lists(lists)}
+
+
+def ivfflat_probes_for_lists(lists: int) -> int:
+    """
+    根据IVFFlat索引的lists选择查询时的probes，取√lists（至少10）
+    
+    Args:
+        lists: 索引的聚类数
+        
+    Returns:
+        probes
+    """
+    return max(10, int(math.sqrt(lists)))
+
+
 class PGVectorManager:
     """PostgreSQL向量存储管理器"""
     
@@ -30,23 +393,41 @@ class PGVectorManager:
         self.base_table_name = table_name
         # 实际表名（LlamaIndex会自动添加"data_"前缀）
         self.actual_table_name = f"data_{table_name}"
-        self.connection_string = Config.PGVECTOR_URL
+        # 拼接SQL时使用的标识符，由psycopg2负责转义
+        self.table_ident = sql.Identifier(self.actual_table_name)
+        self.embedding_index_ident = sql.Identifier(f"{self.actual_table_name}_embedding_idx")
+        self.connection_string = config.PGVECTOR_URL
         if not self.connection_string:
             raise ValueError("未设置PostgreSQL连接URL，请检查环境变量PGVECTOR_URL")
         
         # 嵌入维度
-        self.embed_dim = Config.OPENAI_EMBEDDING_MODEL_DIM
+        self.embed_dim = config.OPENAI_EMBEDDING_MODEL_DIM
         logger.info(f"使用嵌入向量维度: {self.embed_dim}")
         
         self.vector_store = None
         self.storage_context = None
         self.index = None
-        # 保存一个单独的数据库连接用于辅助操作
-        self.conn = None
+        # 辅助操作使用的数据库连接池
+        self.pool = None
         # 混合搜索设置
         self.hybrid_search = True
         # 文本搜索配置，使用PostgreSQL默认支持的'simple'
         self.text_search_config = "simple"
+        # HNSW索引参数，向量以halfvec存储，使用halfvec_cosine_ops
+        # 初始化时会根据表中的向量数量重新调整
+        self.hnsw_kwargs = {
+            **configure_hnsw_params(0),
+            "hnsw_dist_method": "halfvec_cosine_ops",
+        }
+        # 向量索引类型，hnsw或ivfflat
+        self.index_kind = config.PGVECTOR_INDEX_KIND
+        # IVFFlat索引参数，同样根据向量数量调整
+        self.ivfflat_kwargs = {
+            **configure_ivfflat_params(0),
+            "ivfflat_dist_method": "halfvec_cosine_ops",
+        }
+        # 批量入库期间向量索引已被删除，写入完成后由rebuild_embedding_index重建
+        self.index_deferred = False
         
     def initialize(self) -> None:
         """初始化向量存储"""
@@ -58,82 +439,108 @@ class PGVectorManager:
                 
             logger.info("尝试初始化PostgreSQL向量存储...")
             
-            # 创建一个单独的数据库连接用于辅助操作
+            # 创建辅助操作使用的连接池
             try:
-                self.conn = psycopg2.connect(self.connection_string)
-                # 设置自动提交为True
-                self.conn.autocommit = True
-                logger.info("成功创建辅助数据库连接，已启用自动提交")
+                if self.pool is None:
+                    self.pool = psycopg2.pool.ThreadedConnectionPool(
+                        minconn=2,
+                        maxconn=config.PG_POOL_MAX,
+                        dsn=self.connection_string,
+                        keepalives=1,
+                        keepalives_idle=30,
+                    )
+                logger.info(f"成功创建辅助数据库连接池，最大连接数: {config.PG_POOL_MAX}")
                 
                 # 首先检查pgvector扩展是否已安装
                 try:
-                    with self.conn.cursor() as cursor:
+                    with self._cursor() as cursor:
                         cursor.execute("CREATE EXTENSION IF NOT EXISTS vector;")
                         logger.info("确保pgvector扩展已安装")
                 except Exception as e:
                     logger.warning(f"创建pgvector扩展失败: {str(e)}，可能需要手动安装")
             except Exception as conn_err:
-                logger.warning(f"创建辅助数据库连接失败: {str(conn_err)}，某些功能可能不可用")
-                self.conn = None
+                logger.warning(f"创建辅助数据库连接池失败: {str(conn_err)}，某些功能可能不可用")
+                self.pool = None
+
+            # 根据现有向量数量调整索引参数
+            vector_count = self.get_document_count()
+            self._update_index_params(vector_count)
+            logger.info(f"当前向量数量: {vector_count}，索引类型: {self.index_kind}，索引参数: {self.get_query_params()}")
 
             # 检查表是否存在，如果不存在则创建表
-            if self.conn:
+            if self.pool:
                 try:
-                    with self.conn.cursor() as cursor:
+                    with self._cursor() as cursor:
                         # 检查实际表名（带data_前缀）
-                        cursor.execute(f"SELECT EXISTS (SELECT FROM information_schema.tables WHERE table_name = '{self.actual_table_name}')")
+                        cursor.execute(
+                            "SELECT EXISTS (SELECT FROM information_schema.tables WHERE table_name = %s)",
+                            (self.actual_table_name,)
+                        )
                         table_exists = cursor.fetchone()[0]
                         
                         if not table_exists:
                             logger.info(f"表 {self.actual_table_name} 不存在，尝试创建...")
                             # 创建表的SQL，使用simple文本搜索配置
-                            create_table_sql = f"""
-                            CREATE TABLE IF NOT EXISTS {self.actual_table_name} (
+                            create_table_sql = sql.SQL("""
+                            CREATE TABLE IF NOT EXISTS {table} (
                                 id BIGSERIAL NOT NULL,
                                 text VARCHAR NOT NULL,
                                 metadata_ JSON,
                                 node_id VARCHAR,
-                                embedding VECTOR({self.embed_dim}),
-                                text_search_tsv TSVECTOR GENERATED ALWAYS AS (to_tsvector('{self.text_search_config}', text)) STORED,
+                                embedding halfvec({dim}),
+                                text_search_tsv TSVECTOR GENERATED ALWAYS AS (to_tsvector({ts_config}, text)) STORED,
                                 PRIMARY KEY (id)
                             );
-                            """
+                            """).format(
+                                table=self.table_ident,
+                                dim=sql.Literal(self.embed_dim),
+                                ts_config=sql.Literal(self.text_search_config),
+                            )
                             cursor.execute(create_table_sql)
                             
                             # 创建索引
-                            create_index_sql = f"""
-                            CREATE INDEX IF NOT EXISTS {self.actual_table_name}_text_search_idx 
-                            ON {self.actual_table_name} USING GIN (text_search_tsv);
-                            
-                            CREATE INDEX IF NOT EXISTS {self.actual_table_name}_embedding_idx
-                            ON {self.actual_table_name} USING ivfflat (embedding vector_cosine_ops)
-                            WITH (lists = 100);
-                            """
+                            create_index_sql = sql.SQL("""
+                            CREATE INDEX IF NOT EXISTS {index} 
+                            ON {table} USING GIN (text_search_tsv);
+                            """).format(
+                                index=sql.Identifier(f"{self.actual_table_name}_text_search_idx"),
+                                table=self.table_ident,
+                            )
                             cursor.execute(create_index_sql)
+                            self._create_embedding_index(cursor)
                             
                             logger.info(f"表 {self.actual_table_name} 创建成功，并添加了必要的索引")
                         else:
                             # 检查text_search_tsv列是否存在
-                            cursor.execute(f"""
+                            cursor.execute("""
                             SELECT EXISTS (
                                 SELECT FROM information_schema.columns 
-                                WHERE table_name = '{self.actual_table_name}' AND column_name = 'text_search_tsv'
+                                WHERE table_name = %s AND column_name = 'text_search_tsv'
                             )
-                            """)
+                            """, (self.actual_table_name,))
                             tsvector_exists = cursor.fetchone()[0]
                             
                             if not tsvector_exists:
                                 logger.info(f"表 {self.actual_table_name} 缺少text_search_tsv列，添加该列...")
-                                alter_table_sql = f"""
-                                ALTER TABLE {self.actual_table_name} 
+                                alter_table_sql = sql.SQL("""
+                                ALTER TABLE {table} 
                                 ADD COLUMN text_search_tsv TSVECTOR 
-                                GENERATED ALWAYS AS (to_tsvector('{self.text_search_config}', text)) STORED;
-                                
-                                CREATE INDEX IF NOT EXISTS {self.actual_table_name}_text_search_idx 
-                                ON {self.actual_table_name} USING GIN (text_search_tsv);
-                                """
+                                GENERATED ALWAYS AS (to_tsvector({ts_config}, text)) STORED;
+                                """).format(
+                                    table=self.table_ident,
+                                    ts_config=sql.Literal(self.text_search_config),
+                                )
                                 cursor.execute(alter_table_sql)
-                                logger.info(f"成功为表 {self.actual_table_name} 添加text_search_tsv列和索引")
+                                logger.info(f"成功为表 {self.actual_table_name} 添加text_search_tsv列")
+                            
+                            # 确保BM25检索能走GIN索引，而不是逐行扫描text_search_tsv
+                            self._ensure_text_search_index(cursor)
+                            
+                            # 将旧的VECTOR列迁移为halfvec
+                            self._migrate_embedding_to_halfvec(cursor)
+                            
+                            # 索引类型与配置不一致时重建向量索引
+                            self._ensure_embedding_index_kind(cursor, vector_count)
                             
                             logger.info(f"表 {self.actual_table_name} 已存在并验证了结构")
                 except Exception as e:
@@ -150,7 +557,7 @@ class PGVectorManager:
             try:
                 logger.info(f"使用from_params方法创建PGVectorStore (hybrid_search={self.hybrid_search})...")
                 
-                self.vector_store = PGVectorStore.from_params(
+                self.vector_store = HalfVecPGVectorStore.from_params(
                     host=url.host,
                     port=url.port or 5432,
                     database=url.database,
@@ -175,13 +582,278 @@ class PGVectorManager:
             logger.error(f"初始化PostgreSQL向量存储失败: {str(e)}")
             raise
     
-    def create_index_from_nodes(self, nodes: List[BaseNode], service_context=None) -> VectorStoreIndex:
+    def _update_index_params(self, vector_count: int) -> None:
+        """
+        根据向量数量更新HNSW和IVFFlat索引参数
+        
+        Args:
+            vector_count: 表中的向量数量
+        """
+        self.hnsw_kwargs.update(configure_hnsw_params(vector_count))
+        self.ivfflat_kwargs.update(configure_ivfflat_params(vector_count))
+    
+    def get_query_params(self) -> Dict[str, Any]:
+        """
+        获取查询时需要设置的向量索引参数
+        
+        Returns:
+            HNSW索引返回hnsw_kwargs（含hnsw_ef_search），IVFFlat索引返回ivfflat_probes
+        """
+        if self.index_kind == "ivfflat":
+            return {"ivfflat_probes": self.ivfflat_kwargs["ivfflat_probes"]}
+        return dict(self.hnsw_kwargs)
+    
+    def _create_embedding_index(self, cursor, vector_count: Optional[int] = None) -> None:
+        """
+        按配置的索引类型创建embedding列的向量索引
+        
+        Args:
+            cursor: 数据库游标
+            vector_count: 表中的向量数量，仅IVFFlat索引使用
+        """
+        # 索引构建参数是会话级的，连接归还连接池后仍然有效，建完索引后恢复默认值
+        self._set_maintenance_params(cursor)
+        try:
+            if self.index_kind == "ivfflat":
+                self._create_ivfflat_index(cursor, vector_count or 0)
+            else:
+                self._create_hnsw_index(cursor)
+        finally:
+            self._reset_maintenance_params(cursor)
+    
+    def _create_hnsw_index(self, cursor) -> None:
+        """
+        创建embedding列的HNSW索引
+        
+        Args:
+            cursor: 数据库游标
+        """
+        dist_method = self.hnsw_kwargs["hnsw_dist_method"]
+        m = self.hnsw_kwargs["hnsw_m"]
+        ef_construction = self.hnsw_kwargs["hnsw_ef_construction"]
+        cursor.execute(sql.SQL("""
+        CREATE INDEX IF NOT EXISTS {index}
+        ON {table} USING hnsw (embedding {dist_method})
+        WITH (m = {m}, ef_construction = {ef_construction});
+        """).format(
+            index=self.embedding_index_ident,
+            table=self.table_ident,
+            dist_method=sql.SQL(dist_method),
+            m=sql.Literal(m),
+            ef_construction=sql.Literal(ef_construction),
+        ))
+        logger.info(f"确保表 {self.actual_table_name} 的embedding列已建立HNSW索引")
+    
+    def _create_ivfflat_index(self, cursor, vector_count: int) -> None:
+        """
+        创建embedding列的IVFFlat索引
+        
+        IVFFlat的聚类中心在建索引时根据已有数据训练，空表上建索引会导致召回率很差，
+        因此空表时跳过，等首次写入数据后再建
+        
+        Args:
+            cursor: 数据库游标
+            vector_count: 表中的向量数量
+        """
+        if vector_count <= 0:
+            logger.info(f"表 {self.actual_table_name} 暂无数据，IVFFlat索引将在写入数据后创建")
+            return
+        
+        dist_method = self.ivfflat_kwargs["ivfflat_dist_method"]
+        lists = self.ivfflat_kwargs["ivfflat_lists"]
+        if vector_count < lists * 10:
+            logger.warning(f"向量数量 {vector_count} 少于 lists*10 ({lists * 10})，IVFFlat索引的召回率可能较低")
+        
+        cursor.execute(sql.SQL("""
+        CREATE INDEX IF NOT EXISTS {index}
+        ON {table} USING ivfflat (embedding {dist_method})
+        WITH (lists = {lists});
+        """).format(
+            index=self.embedding_index_ident,
+            table=self.table_ident,
+            dist_method=sql.SQL(dist_method),
+            lists=sql.Literal(lists),
+        ))
+        logger.info(f"确保表 {self.actual_table_name} 的embedding列已建立IVFFlat索引，lists: {lists}")
+        self._sync_ivfflat_params(cursor)
+    
+    def _sync_ivfflat_params(self, cursor) -> None:
+        """
+        按已建成的IVFFlat索引实际使用的lists设置probes
+        
+        索引已存在时CREATE INDEX IF NOT EXISTS不会重建，索引的lists仍是建索引时的值，
+        而根据当前向量数量算出的lists会随数据增长变化，probes必须与索引实际的lists匹配
+        
+        Args:
+            cursor: 数据库游标
+        """
+        cursor.execute(
+            "SELECT reloptions FROM pg_class WHERE relname = %s AND relkind = 'i'",
+            (f"{self.actual_table_name}_embedding_idx",)
+        )
+        row = cursor.fetchone()
+        for option in (row[0] or []) if row else []:
+            name, _, value = option.partition("=")
+            if name == "lists":
+                lists = int(value)
+                self.ivfflat_kwargs["ivfflat_lists"] = lists
+                self.ivfflat_kwargs["ivfflat_probes"] = ivfflat_probes_for_lists(lists)
+                return
+    
+    def _ensure_embedding_index_kind(self, cursor, vector_count: int) -> None:
+        """
+        检查已有向量索引的类型，与配置的索引类型不一致时删除并重建
+        
+        Args:
+            cursor: 数据库游标
+            vector_count: 表中的向量数量
+        """
+        cursor.execute(
+            "SELECT indexdef FROM pg_indexes WHERE tablename = %s AND indexname = %s",
+            (self.actual_table_name, f"{self.actual_table_name}_embedding_idx")
+        )
+        row = cursor.fetchone()
+        if row and f"USING {self.index_kind} " in row[0]:
+            if self.index_kind == "ivfflat":
+                self._sync_ivfflat_params(cursor)
+            return
+        
+        if row:
+            logger.info(f"表 {self.actual_table_name} 的向量索引类型与配置 ({self.index_kind}) 不一致，重建索引...")
+            cursor.execute(sql.SQL("DROP INDEX IF EXISTS {}").format(self.embedding_index_ident))
+        self._create_embedding_index(cursor, vector_count)
+    
+    @contextmanager
+    def _cursor(self) -> Iterator[Any]:
+        """
+        从连接池借出一个自动提交的连接并返回游标，用完后归还连接
+        
+        Yields:
+            数据库游标
+        """
+        conn = self.pool.getconn()
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                yield cursor
+        finally:
+            # 已断开的连接直接丢弃，连接池会按需重新创建
+            self.pool.putconn(conn, close=bool(conn.closed))
+    
+    def _execute_prepared(self, cursor, name: str, statement: Union[str, sql.Composable], params: Optional[tuple] = None) -> None:
+        """
+        执行服务端预备语句，当前连接上尚未准备时先PREPARE再执行
+        
+        预备语句只在所属连接上有效，连接池中的每个连接会在首次使用时各自准备一次
+        
+        Args:
+            cursor: 数据库游标
+            name: 预备语句名
+            statement: 语句内容，参数使用$1、$2占位，可以是已拼接好标识符的sql.Composable
+            params: 语句参数
+        """
+        name_ident = sql.Identifier(name)
+        placeholders = f"({', '.join(['%s'] * len(params))})" if params else ""
+        execute_sql = sql.SQL("EXECUTE {}").format(name_ident) + sql.SQL(placeholders)
+        try:
+            cursor.execute(execute_sql, params)
+        except psycopg2.errors.InvalidSqlStatementName:
+            # 连接处于自动提交模式，失败的EXECUTE不会影响后续语句
+            if isinstance(statement, str):
+                statement = sql.SQL(statement)
+            cursor.execute(sql.SQL("PREPARE {} AS ").format(name_ident) + statement)
+            cursor.execute(execute_sql, params)
+    
+    def _ensure_text_search_index(self, cursor) -> None:
+        """
+        确保text_search_tsv列上存在GIN索引，已有GIN索引（无论索引名）时不重复创建
+        
+        Args:
+            cursor: 数据库游标
+        """
+        cursor.execute(
+            """
+            SELECT EXISTS (
+                SELECT FROM pg_indexes
+                WHERE tablename = %s AND indexdef ILIKE '%%USING gin (text_search_tsv)%%'
+            )
+            """,
+            (self.actual_table_name,)
+        )
+        if cursor.fetchone()[0]:
+            return
+        
+        cursor.execute(sql.SQL("""
+        CREATE INDEX IF NOT EXISTS {index}
+        ON {table} USING GIN (text_search_tsv);
+        """).format(
+            index=sql.Identifier(f"{self.actual_table_name}_text_search_idx"),
+            table=self.table_ident,
+        ))
+        logger.info(f"成功为表 {self.actual_table_name} 的text_search_tsv列添加GIN索引")
+    
+    def _set_maintenance_params(self, cursor) -> None:
+        """
+        设置索引构建所用的会话参数，使用更大的内存和并行worker加速HNSW构建
+        
+        Args:
+            cursor: 数据库游标
+        """
+        cursor.execute("SET maintenance_work_mem = %s", (config.PG_MAINT_WORK_MEM,))
+        cursor.execute("SET max_parallel_maintenance_workers = %s", (config.PG_MAINT_WORKERS,))
+        cursor.execute("SET max_parallel_workers = %s", (config.PG_MAINT_WORKERS + 1,))
+    
+    def _reset_maintenance_params(self, cursor) -> None:
+        """
+        将索引构建所用的会话参数恢复为默认值，避免之后借用同一连接的查询继承这些设置
+        
+        Args:
+            cursor: 数据库游标
+        """
+        try:
+            cursor.execute("RESET maintenance_work_mem")
+            cursor.execute("RESET max_parallel_maintenance_workers")
+            cursor.execute("RESET max_parallel_workers")
+        except Exception as e:
+            # 连接已断开时会被连接池丢弃，不影响其他连接
+            logger.warning(f"恢复索引构建参数失败: {str(e)}")
+    
+    def _migrate_embedding_to_halfvec(self, cursor) -> None:
+        """
+        将已有表的embedding列从VECTOR迁移为halfvec，已迁移时不做任何操作
+        
+        Args:
+            cursor: 数据库游标
+        """
+        cursor.execute(
+            """
+            SELECT udt_name FROM information_schema.columns
+            WHERE table_name = %s AND column_name = 'embedding'
+            """,
+            (self.actual_table_name,)
+        )
+        row = cursor.fetchone()
+        if not row or row[0] == "halfvec":
+            return
+        
+        logger.info(f"表 {self.actual_table_name} 的embedding列类型为 {row[0]}，迁移为halfvec({self.embed_dim})...")
+        # 旧索引基于vector_cosine_ops，无法用于halfvec列，需先删除再重建
+        cursor.execute(sql.SQL("DROP INDEX IF EXISTS {}").format(self.embedding_index_ident))
+        cursor.execute(sql.SQL("""
+        ALTER TABLE {table}
+        ALTER COLUMN embedding TYPE halfvec({dim})
+        USING embedding::halfvec({dim})
+        """).format(table=self.table_ident, dim=sql.Literal(self.embed_dim)))
+        self._create_embedding_index(cursor, self.get_document_count())
+        logger.info(f"成功将表 {self.actual_table_name} 的embedding列迁移为halfvec")
+    
+    def create_index_from_nodes(self, nodes: List[BaseNode], embed_model: Optional[BaseEmbedding] = None) -> VectorStoreIndex:
         """
         从节点列表创建索引
         
         Args:
             nodes: 文档节点列表
-            service_context: 服务上下文
+            embed_model: 嵌入模型，未提供时使用Settings.embed_model
             
         Returns:
             创建的索引对象
@@ -189,19 +861,26 @@ class PGVectorManager:
         if not self.storage_context:
             self.initialize()
         
+        # 预先批量计算嵌入，VectorStoreIndex会跳过已有embedding的节点
+        embed_model = embed_model or Settings.embed_model
+        self.embed_nodes(nodes, embed_model)
+        
         try:
             # 创建索引 (自动提交模式，不需要显式commit)
-            if service_context:
-                self.index = VectorStoreIndex(
-                    nodes=nodes,
-                    storage_context=self.storage_context,
-                    service_context=service_context
-                )
-            else:
-                self.index = VectorStoreIndex(
-                    nodes=nodes,
-                    storage_context=self.storage_context
-                )
+            self.index = VectorStoreIndex(
+                nodes=nodes,
+                storage_context=self.storage_context,
+                embed_model=embed_model
+            )
+            
+            # 更新统计信息，使get_document_count的reltuples估算保持准确
+            if self.pool:
+                with self._cursor() as cursor:
+                    cursor.execute(sql.SQL("ANALYZE {}").format(self.table_ident))
+            
+            # IVFFlat索引需要在有数据后创建；批量入库期间索引已删除，留待写入完成后重建
+            if self.index_kind == "ivfflat" and self.pool and not self.index_deferred:
+                self.rebuild_embedding_index()
                 
             logger.info(f"成功创建索引，包含 {len(nodes)} 个文档节点")
             return self.index
@@ -209,6 +888,59 @@ class PGVectorManager:
             logger.error(f"创建索引失败: {str(e)}")
             raise
     
+    def should_defer_index(self, incoming_rows: int) -> bool:
+        """
+        判断批量入库时是否应先删除向量索引，写入完成后再一次性重建
+        
+        Args:
+            incoming_rows: 预计写入的行数
+            
+        Returns:
+            入库后语料规模达到DEFER_INDEX_THRESHOLD，且新写入的行数不少于已有行数时返回True
+        """
+        if not self.pool:
+            return False
+        existing = self.get_document_count()
+        # 已有数据比新数据多时，重建整个索引反而比逐行维护更慢
+        return existing + incoming_rows >= DEFER_INDEX_THRESHOLD and incoming_rows >= existing
+    
+    def drop_embedding_index(self) -> None:
+        """删除向量索引，之后的写入不再维护索引，需调用rebuild_embedding_index重建"""
+        with self._cursor() as cursor:
+            cursor.execute(sql.SQL("DROP INDEX IF EXISTS {}").format(self.embedding_index_ident))
+        self.index_deferred = True
+        logger.info(f"已暂时删除表 {self.actual_table_name} 的向量索引，写入完成后重建")
+    
+    def rebuild_embedding_index(self) -> None:
+        """按当前的向量数量调整索引参数并创建向量索引"""
+        vector_count = self.get_document_count()
+        self._update_index_params(vector_count)
+        with self._cursor() as cursor:
+            self._create_embedding_index(cursor, vector_count)
+        self.index_deferred = False
+    
+    def embed_nodes(self, nodes: List[BaseNode], embed_model) -> None:
+        """
+        批量计算节点的嵌入向量并写回节点
+        
+        Args:
+            nodes: 文档节点列表
+            embed_model: 嵌入模型
+        """
+        pending = [node for node in nodes if node.embedding is None]
+        if not pending:
+            return
+        
+        logger.info(f"批量计算 {len(pending)} 个节点的嵌入向量")
+        for start in range(0, len(pending), EMBED_CHUNK_SIZE):
+            batch = pending[start:start + EMBED_CHUNK_SIZE]
+            embeddings = embed_model.get_text_embedding_batch(
+                [node.get_content(metadata_mode=MetadataMode.EMBED) for node in batch],
+                show_progress=True,
+            )
+            for node, embedding in zip(batch, embeddings):
+                node.embedding = embedding
+    
     def get_index(self) -> Optional[VectorStoreIndex]:
         """获取当前索引对象"""
         return self.index
@@ -222,37 +954,46 @@ class PGVectorManager:
             except Exception as e:
                 logger.error(f"清空数据失败: {str(e)}")
                 # 尝试使用直接SQL语句清空数据
-                if self.conn and not self.conn.closed:
+                if self.pool:
                     try:
-                        with self.conn.cursor() as cursor:
-                            cursor.execute(f"TRUNCATE TABLE {self.actual_table_name}")
+                        with self._cursor() as cursor:
+                            cursor.execute(sql.SQL("TRUNCATE TABLE {}").format(self.table_ident))
                             logger.info(f"通过SQL语句清空表 {self.actual_table_name} 成功")
                     except Exception as sql_err:
                         logger.error(f"通过SQL语句清空数据失败: {str(sql_err)}")
     
     def get_document_count(self) -> int:
         """获取存储的文档数量"""
-        if not self.vector_store:
+        if not self.vector_store and not self.pool:
             return 0
             
         try:
             # 使用独立的数据库连接查询
-            if self.conn and not self.conn.closed:
+            if self.pool:
                 try:
-                    with self.conn.cursor() as cursor:
-                        # 先检查表是否存在
-                        cursor.execute(
-                            "SELECT EXISTS (SELECT FROM information_schema.tables WHERE table_name = %s)",
+                    with self._cursor() as cursor:
+                        # 使用pg_class中的估算行数，无需扫描全表；查不到记录说明表不存在
+                        self._execute_prepared(
+                            cursor,
+                            "reltuples_stmt",
+                            "SELECT reltuples::bigint FROM pg_class WHERE relname = $1 AND relkind = 'r'",
                             (self.actual_table_name,)
                         )
-                        table_exists = cursor.fetchone()[0]
+                        row = cursor.fetchone()
                         
-                        if not table_exists:
+                        if row is None:
                             logger.info(f"表 {self.actual_table_name} 不存在，可能是首次运行")
                             return 0
+                        
+                        if row[0] >= 0:
+                            return row[0]
                             
-                        # 表存在，查询数量
-                        cursor.execute(f"SELECT COUNT(*) FROM {self.actual_table_name}")
+                        # 表从未被ANALYZE过（reltuples为-1），回退到精确计数
+                        self._execute_prepared(
+                            cursor,
+                            f"cnt_{self.actual_table_name}",
+                            sql.SQL("SELECT COUNT(*) FROM {}").format(self.table_ident)
+                        )
                         count = cursor.fetchone()[0]
                         return count
                 except Exception as sql_err:
@@ -276,8 +1017,8 @@ class PGVectorManager:
     def __del__(self):
         """析构函数，确保关闭数据库连接"""
         try:
-            if self.conn and not self.conn.closed:
-                self.conn.close()
-                logger.info("数据库连接已关闭")
+            if self.pool and not self.pool.closed:
+                self.pool.closeall()
+                logger.info("数据库连接池已关闭")
         except Exception as e:
             logger.error(f"关闭数据库连接时出错: {str(e)}") 
\ No newline at end of file
@@ -11,7 +11,7 @@ from llama_index.readers.file import PDFReader
 from llama_index.core.schema import Document, BaseNode
 from llama_index.core.node_parser import SentenceSplitter
 
-from app.utils.config import Config
+from app.utils.config import config
 
 logger = logging.getLogger(__name__)
 
@@ -29,8 +29,8 @@ class PDFProcessor:
             chunk_overlap: 文档分块重叠大小
         """
         self.pdf_reader = PDFReader()
-        self.chunk_size = chunk_size or Config.CHUNK_SIZE
-        self.chunk_overlap = chunk_overlap or Config.CHUNK_OVERLAP
+        self.chunk_size = chunk_size or config.CHUNK_SIZE
+        self.chunk_overlap = chunk_overlap or config.CHUNK_OVERLAP
         
         self.node_parser = SentenceSplitter(
             chunk_size=self.chunk_size,
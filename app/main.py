@@ -18,7 +18,7 @@ project_root = os.path.dirname(app_dir)
 sys.path.insert(0, project_root)
 
 from app.utils.logger import setup_logging
-from app.utils.config import Config
+from app.utils.config import config
 from app.web.gradio_interface import GradioInterface
 
 # 设置日志
@@ -31,14 +31,14 @@ def parse_args():
     parser.add_argument(
         "--port", 
         type=int, 
-        default=Config.APP_PORT,
+        default=config.APP_PORT,
         help="Web服务端口"
     )
     
     parser.add_argument(
         "--host", 
         type=str, 
-        default=Config.APP_HOST,
+        default=config.APP_HOST,
         help="Web服务主机"
     )
     
@@ -57,15 +57,15 @@ def main():
     
     # 验证配置
     try:
-        Config.validate_config()
+        config.validate_config()
     except ValueError as e:
         logger.error(f"配置验证失败: {str(e)}")
         return
     
     logger.info("正在启动PDF知识库RAG应用...")
     logger.info(f"服务地址: {args.host}:{args.port}")
-    logger.info(f"使用LLM模型: {Config.OPENAI_MODEL_NAME}")
-    logger.info(f"使用嵌入模型: {Config.OPENAI_EMBEDDING_MODEL_NAME} (维度: {Config.OPENAI_EMBEDDING_MODEL_DIM})")
+    logger.info(f"使用LLM模型: {config.OPENAI_MODEL_NAME}")
+    logger.info(f"使用嵌入模型: {config.OPENAI_EMBEDDING_MODEL_NAME} (维度: {config.OPENAI_EMBEDDING_MODEL_DIM})")
     
     try:
         # 创建Gradio界面
@@ -3,90 +3,148 @@
 """
 
 import os
+from dataclasses import dataclass
 from dotenv import load_dotenv
-from typing import Dict, Optional, Any
+from typing import ClassVar, Dict, FrozenSet, Optional, Any
 
 # 加载环境变量
 load_dotenv()
 
+
+def _parse_embed_dim(value: Optional[str]) -> int:
+    """安全地解析嵌入维度，确保它是有效的正整数，否则使用默认值1536"""
+    if value is None or value.lower() == "none" or not value.strip():
+        # 如果环境变量未设置、为"None"或为空，使用默认值
+        return 1536
+    try:
+        embed_dim = int(value)
+    except ValueError:
+        print(f"警告: 无法将嵌入维度值 '{value}' 转换为整数，使用默认值1536")
+        return 1536
+    if embed_dim <= 0:
+        print(f"警告: 嵌入维度值 {embed_dim} 无效，使用默认值1536")
+        return 1536
+    return embed_dim
+
+
+@dataclass(frozen=True)
 class Config:
-    """配置类，提供对环境变量的访问"""
+    """配置类，启动时从环境变量构建一次，之后不可修改"""
     
     # 有效的OpenAI模型列表
-    VALID_OPENAI_MODELS = [
+    VALID_OPENAI_MODELS: ClassVar[FrozenSet[str]] = frozenset({
         "gpt-4", "gpt-4-32k", "gpt-4-1106-preview", "gpt-4-0125-preview", 
         "gpt-4-turbo-preview", "gpt-4-vision-preview", "gpt-4-0613", 
         "gpt-4-32k-0613", "gpt-4-0314", "gpt-4-32k-0314", "gpt-3.5-turbo", 
         "gpt-3.5-turbo-16k", "gpt-3.5-turbo-0125", "gpt-3.5-turbo-1106", 
         "gpt-3.5-turbo-0613", "gpt-3.5-turbo-16k-0613", "gpt-3.5-turbo-0301",
         "text-davinci-003", "text-davinci-002", "gpt-3.5-turbo-instruct"
-    ]
+    })
     
     # 默认模型
-    DEFAULT_OPENAI_MODEL = "gpt-3.5-turbo"
+    DEFAULT_OPENAI_MODEL: ClassVar[str] = "gpt-3.5-turbo"
+    
+    # 支持的向量索引类型
+    VALID_INDEX_KINDS: ClassVar[FrozenSet[str]] = frozenset({"hnsw", "ivfflat"})
     
     # 数据库配置
-    PGVECTOR_URL = os.getenv("PGVECTOR_URL")  # PostgreSQL数据库连接URL
+    PGVECTOR_URL: Optional[str]  # PostgreSQL数据库连接URL
+    PG_POOL_MAX: int  # 辅助操作连接池的最大连接数
     
     # OpenAI配置
-    OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-    
-    # 获取模型名称并验证
-    _model_name = os.getenv("OPENAI_MODEL_NAME", DEFAULT_OPENAI_MODEL)
-    # 如果模型名称无效，使用默认模型
-    OPENAI_MODEL_NAME = _model_name if _model_name in VALID_OPENAI_MODELS else DEFAULT_OPENAI_MODEL
+    OPENAI_API_KEY: Optional[str]
+    OPENAI_MODEL_NAME: str
     
     # OpenAI Embedding配置
-    OPENAI_EMBEDDING_MODEL_NAME = os.getenv("OPENAI_EMBEDDING_MODEL_NAME", "text-embedding-3-small")
-    
-    # 安全地获取嵌入维度，确保它是有效的整数
-    _embed_dim_str = os.getenv("OPENAI_EMBEDDING_MODEL_DIM")
-    if _embed_dim_str is None or _embed_dim_str.lower() == "none" or not _embed_dim_str.strip():
-        # 如果环境变量未设置、为"None"或为空，使用默认值
-        OPENAI_EMBEDDING_MODEL_DIM = 1536
-    else:
-        try:
-            OPENAI_EMBEDDING_MODEL_DIM = int(_embed_dim_str)
-            if OPENAI_EMBEDDING_MODEL_DIM <= 0:
-                print(f"警告: 嵌入维度值 {OPENAI_EMBEDDING_MODEL_DIM} 无效，使用默认值1536")
-                OPENAI_EMBEDDING_MODEL_DIM = 1536
-        except ValueError:
-            print(f"警告: 无法将嵌入维度值 '{_embed_dim_str}' 转换为整数，使用默认值1536")
-            OPENAI_EMBEDDING_MODEL_DIM = 1536
+    OPENAI_EMBEDDING_MODEL_NAME: str
+    OPENAI_EMBEDDING_MODEL_DIM: int
+    # 单次嵌入API请求包含的文本数量（OpenAI上限为2048条，同时受单次请求token总数限制）
+    EMBED_BATCH_SIZE: int
     
     # 应用配置
-    APP_PORT = int(os.getenv("APP_PORT", "7860"))
-    APP_HOST = os.getenv("APP_HOST", "0.0.0.0")
+    APP_PORT: int
+    APP_HOST: str
+    THREAD_POOL_SIZE: int  # 界面处理阻塞操作（文件入库等）使用的线程池大小
+    GRADIO_CONCURRENCY: int  # 每个事件同时处理的请求数
+    GRADIO_QUEUE_MAX: int  # 请求队列的最大长度
+    GRADIO_SHARE: bool  # 是否创建Gradio公开分享链接
     
     # 文档处理配置
-    CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "1000"))
-    CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "200"))
+    CHUNK_SIZE: int
+    CHUNK_OVERLAP: int
+    
+    # 向量索引类型，可选"hnsw"或"ivfflat"（语料较小、需要快速建索引时可选ivfflat）
+    PGVECTOR_INDEX_KIND: str
+    
+    # 向量索引构建配置（构建向量索引时的会话参数）
+    PG_MAINT_WORK_MEM: str
+    PG_MAINT_WORKERS: int
+    
+    # 查询配置
+    QUERY_EMBED_CACHE_SIZE: int  # 查询向量LRU缓存容量
+    CITATION_MAX_CHARS: int  # 每条引用返回的最大字符数
+    QUERY_RESULT_CACHE_SIZE: int  # 界面层查询结果LRU缓存容量
     
     @classmethod
-    def validate_config(cls):
+    def from_env(cls) -> "Config":
+        """从环境变量构建配置"""
+        # 获取模型名称并验证，如果模型名称无效，使用默认模型
+        model_name = os.getenv("OPENAI_MODEL_NAME", cls.DEFAULT_OPENAI_MODEL)
+        if model_name not in cls.VALID_OPENAI_MODELS:
+            print(f"警告: 模型名称 '{model_name}' 无效，将使用默认模型 '{cls.DEFAULT_OPENAI_MODEL}'")
+            model_name = cls.DEFAULT_OPENAI_MODEL
+        
+        # 获取向量索引类型并验证，无效时使用hnsw
+        index_kind = os.getenv("PGVECTOR_INDEX_KIND", "hnsw").lower()
+        if index_kind not in cls.VALID_INDEX_KINDS:
+            print(f"警告: 向量索引类型 '{index_kind}' 无效，将使用 'hnsw'")
+            index_kind = "hnsw"
+        
+        return cls(
+            PGVECTOR_URL=os.getenv("PGVECTOR_URL"),
+            PG_POOL_MAX=int(os.getenv("PG_POOL_MAX", "10")),
+            OPENAI_API_KEY=os.getenv("OPENAI_API_KEY"),
+            OPENAI_MODEL_NAME=model_name,
+            OPENAI_EMBEDDING_MODEL_NAME=os.getenv("OPENAI_EMBEDDING_MODEL_NAME", "text-embedding-3-small"),
+            OPENAI_EMBEDDING_MODEL_DIM=_parse_embed_dim(os.getenv("OPENAI_EMBEDDING_MODEL_DIM")),
+            EMBED_BATCH_SIZE=int(os.getenv("EMBED_BATCH_SIZE", "256")),
+            APP_PORT=int(os.getenv("APP_PORT", "7860")),
+            APP_HOST=os.getenv("APP_HOST", "0.0.0.0"),
+            THREAD_POOL_SIZE=int(os.getenv("THREAD_POOL_SIZE", "40")),
+            GRADIO_CONCURRENCY=int(os.getenv("GRADIO_CONCURRENCY", "4")),
+            GRADIO_QUEUE_MAX=int(os.getenv("GRADIO_QUEUE_MAX", "64")),
+            GRADIO_SHARE=os.getenv("GRADIO_SHARE", "true").lower() in ("1", "true", "yes"),
+            CHUNK_SIZE=int(os.getenv("CHUNK_SIZE", "1000")),
+            CHUNK_OVERLAP=int(os.getenv("CHUNK_OVERLAP", "200")),
+            PGVECTOR_INDEX_KIND=index_kind,
+            PG_MAINT_WORK_MEM=os.getenv("PG_MAINT_WORK_MEM", "2GB"),
+            PG_MAINT_WORKERS=int(os.getenv("PG_MAINT_WORKERS", "7")),
+            QUERY_EMBED_CACHE_SIZE=int(os.getenv("QUERY_EMBED_CACHE_SIZE", "1024")),
+            CITATION_MAX_CHARS=int(os.getenv("CITATION_MAX_CHARS", "800")),
+            QUERY_RESULT_CACHE_SIZE=int(os.getenv("QUERY_RESULT_CACHE_SIZE", "256")),
+        )
+    
+    def validate_config(self):
         """验证配置是否有效"""
-        if not cls.OPENAI_API_KEY:
+        if not self.OPENAI_API_KEY:
             raise ValueError("未设置OpenAI API Key，请检查.env文件")
         
-        if not cls.PGVECTOR_URL:
+        if not self.PGVECTOR_URL:
             raise ValueError("未设置PostgreSQL连接URL，请检查.env文件")
-        
-        # 验证模型名称
-        if cls.OPENAI_MODEL_NAME not in cls.VALID_OPENAI_MODELS:
-            print(f"警告: 模型名称 '{cls.OPENAI_MODEL_NAME}' 无效，将使用默认模型 '{cls.DEFAULT_OPENAI_MODEL}'")
-            # 使用默认模型
-            cls.OPENAI_MODEL_NAME = cls.DEFAULT_OPENAI_MODEL
 
-    @classmethod
-    def get_active_llm_config(cls) -> Dict[str, Any]:
+    def get_active_llm_config(self) -> Dict[str, Any]:
         """获取当前激活的LLM配置"""
         
         # 优先使用OpenAI
-        if cls.OPENAI_API_KEY:
+        if self.OPENAI_API_KEY:
             return {
-                "api_key": cls.OPENAI_API_KEY,
-                "model_name": cls.OPENAI_MODEL_NAME,
+                "api_key": self.OPENAI_API_KEY,
+                "model_name": self.OPENAI_MODEL_NAME,
                 "provider": "openai"
             }
         else:
-            raise ValueError("未找到有效的LLM配置，请检查.env文件") 
\ No newline at end of file
+            raise ValueError("未找到有效的LLM配置，请检查.env文件")
+
+
+# 全局配置实例
+config = Config.from_env()
@@ -2,28 +2,102 @@
 Gradio Web界面模块，提供用户交互界面
 """
 
+import asyncio
+import atexit
 import os
 import logging
+import shutil
+import sys
 import tempfile
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
 import gradio as gr
-from typing import List, Dict, Any, Optional, Tuple
+import httpx
+from gradio.utils import NamedString
+from typing import AsyncIterator, List, Dict, Any, Optional, Tuple
 
+from app.core.embedding_cache import normalize_query
 from app.core.knowledge_base import KnowledgeBase
-from app.utils.config import Config
+from app.utils.config import config
 
 logger = logging.getLogger(__name__)
 
+# 无法使用硬链接和sendfile时，分块复制文件的块大小
+COPY_CHUNK_SIZE = 1 << 20
+
+# PDF文件开头的魔数
+PDF_MAGIC = b"%PDF-"
+
+
+def _read_str(file_obj: str) -> Tuple[Optional[str], Optional[str]]:
+    """字符串（含Gradio 4.x的NamedString）的值就是临时文件路径"""
+    return file_obj, os.path.basename(file_obj)
+
+
+def _read_tuple(file_obj: tuple) -> Tuple[Optional[str], Optional[str]]:
+    """元组的第一个元素是文件路径，第二个元素是原始文件名"""
+    src_path = file_obj[0] if len(file_obj) > 0 else None
+    filename = os.path.basename(file_obj[1]) if len(file_obj) > 1 else None
+    return src_path, filename
+
+
+def _read_dict(file_obj: dict) -> Tuple[Optional[str], Optional[str]]:
+    """字典中包含路径和文件名"""
+    return file_obj.get('path'), file_obj.get('name')
+
+
+def _read_fallback(file_obj: Any) -> Tuple[Optional[str], Optional[str]]:
+    """类型不在分派表中时，按继承关系和属性逐一判断"""
+    for base, reader in _UPLOAD_READERS.items():
+        if isinstance(file_obj, base):
+            return reader(file_obj)
+    if hasattr(file_obj, 'name'):
+        # 临时文件对象的name属性即文件路径
+        return file_obj.name, os.path.basename(file_obj.name)
+    return None, None
+
+
+# 按上传文件对象的类型分派读取函数，返回（源文件路径, 文件名）
+_UPLOAD_READERS = {
+    NamedString: _read_str,
+    str: _read_str,
+    tuple: _read_tuple,
+    dict: _read_dict,
+}
+
 class GradioInterface:
     """Gradio Web界面类"""
     
     def __init__(self):
         """初始化Gradio界面"""
         self.knowledge_base = None
-        self.temp_dir = tempfile.mkdtemp()
+        # 暂存目录放在Gradio上传缓存目录下，与上传文件位于同一文件系统，保存时可以直接创建硬链接
+        gradio_temp_dir = os.environ.get("GRADIO_TEMP_DIR") or os.path.join(tempfile.gettempdir(), "gradio")
+        try:
+            os.makedirs(gradio_temp_dir, exist_ok=True)
+            self.temp_dir = tempfile.mkdtemp(dir=gradio_temp_dir)
+        except OSError:
+            self.temp_dir = tempfile.mkdtemp()
+        # 处理上传文件时asyncio.to_thread使用的线程池
+        self.executor = ThreadPoolExecutor(max_workers=config.THREAD_POOL_SIZE)
+        self._executor_loop = None
+        # 查询结果LRU缓存，键为规范化后的查询，值为（知识库版本, 回答, 引用）
+        self._query_cache: "OrderedDict[str, Tuple[int, str, str]]" = OrderedDict()
+        self._query_cache_lock = threading.Lock()
+        # 知识库版本号，添加或清空文档后递增，旧版本的缓存结果视为未命中
+        self._kb_version = 0
+        # 知识库在首次使用时才创建，锁保证并发的首批请求只初始化一次
+        self._kb_lock = threading.Lock()
+        # 入库时计算嵌入共用的HTTP/2客户端，复用连接，避免反复进行TLS握手
+        self._http = httpx.Client(
+            http2=True,
+            timeout=60,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=32)
+        )
         logger.info(f"临时文件目录: {self.temp_dir}")
-        print(f"临时文件目录: {self.temp_dir}")
-        self.initialize_knowledge_base()
     
     def initialize_knowledge_base(self, rebuild: bool = False) -> Dict[str, Any]:
         """
@@ -38,221 +112,291 @@ class GradioInterface:
         try:
             # 显示正在初始化的消息
             logger.info("正在初始化知识库...")
-            print("正在初始化知识库...")
             
-            self.knowledge_base = KnowledgeBase(rebuild=rebuild)
+            self.knowledge_base = KnowledgeBase(rebuild=rebuild, http_client=self._http)
+            self._bump_kb_version()
             
             # 验证知识库是否正确初始化
             if self.knowledge_base is None:
                 raise ValueError("知识库初始化后为空")
                 
-            status = self.knowledge_base.get_status()
-            logger.info(f"知识库初始化成功，共有 {status['document_count']} 个文档")
-            print(f"知识库初始化成功，共有 {status['document_count']} 个文档")
+            count = self.knowledge_base.fast_count()
+            logger.info(f"知识库初始化成功，共有 {count} 个文档")
             
-            return {"status": "成功", "message": f"知识库初始化完成，共有 {status['document_count']} 个文档"}
+            return {"status": "成功", "message": f"知识库初始化完成，共有 {count} 个文档"}
         except Exception as e:
             logger.error(f"知识库初始化失败: {str(e)}")
-            print(f"知识库初始化失败: {str(e)}")
             return {"status": "失败", "message": f"知识库初始化失败: {str(e)}"}
     
-    def upload_pdf(self, files: List[Any]) -> Dict[str, Any]:
+    def _get_kb(self) -> KnowledgeBase:
+        """
+        获取知识库，尚未创建时先初始化
+        
+        Returns:
+            知识库对象
+            
+        Raises:
+            ValueError: 知识库初始化失败
+        """
+        kb = self.knowledge_base
+        if kb is None:
+            with self._kb_lock:
+                if self.knowledge_base is None:
+                    init_result = self.initialize_knowledge_base()
+                    if self.knowledge_base is None:
+                        raise ValueError(init_result["message"])
+                kb = self.knowledge_base
+        return kb
+    
+    async def upload_pdf(self, files: List[Any]) -> AsyncIterator[Dict[str, Any]]:
         """
-        上传PDF文件
+        上传PDF文件，多个文件并发保存后一次性批量入库，处理过程中逐步返回进度
         
         Args:
             files: 上传的文件列表
             
-        Returns:
-            处理结果信息
+        Yields:
+            处理进度信息，最后一项为处理结果信息
         """
         if not files:
-            return {"status": "失败", "message": "未选择任何文件"}
+            yield {"status": "失败", "message": "未选择任何文件"}
+            return
             
         try:
+            self._ensure_default_executor()
+            
             # 确保知识库已初始化
-            if not self.knowledge_base:
-                logger.info("知识库未初始化，正在尝试初始化...")
-                print("知识库未初始化，正在尝试初始化...")
-                init_result = self.initialize_knowledge_base()
-                if init_result["status"] == "失败":
-                    return init_result
-                
-            # 再次检查知识库是否成功初始化
-            if not self.knowledge_base:
+            try:
+                kb = await asyncio.to_thread(self._get_kb)
+            except ValueError as e:
                 logger.error("知识库初始化失败，无法上传文件")
-                print("知识库初始化失败，无法上传文件")
-                return {"status": "失败", "message": "知识库初始化失败，无法上传文件"}
-                
-            file_paths = []
-            for file_obj in files:
-                # 打印文件对象类型，帮助调试
-                logger.info(f"文件对象类型: {type(file_obj)}")
-                print(f"文件对象类型: {type(file_obj)}")
-                
-                try:
-                    # 尝试获取文件名（兼容不同版本的Gradio）
-                    if hasattr(file_obj, 'name'):
-                        filename = file_obj.name
-                        logger.info(f"从属性获取文件名: {filename}")
-                    elif isinstance(file_obj, tuple) and len(file_obj) > 1:
-                        filename = os.path.basename(file_obj[1])
-                        logger.info(f"从元组获取文件名: {filename}")
-                    elif isinstance(file_obj, dict) and 'name' in file_obj:
-                        filename = file_obj['name']
-                        logger.info(f"从字典获取文件名: {filename}")
-                    else:
-                        # 如果无法获取文件名，生成一个随机文件名
-                        timestamp = int(time.time())
-                        filename = f"uploaded_file_{timestamp}.pdf"
-                        logger.info(f"使用生成的文件名: {filename}")
-                    
-                    # 处理中文文件名：确保能够正确编码
-                    try:
-                        # 尝试使用纯ASCII文件名（替换或删除非ASCII字符）
-                        safe_filename = ''.join(c if ord(c) < 128 else '_' for c in filename)
-                        if safe_filename != filename:
-                            logger.info(f"将中文文件名 '{filename}' 转换为安全文件名 '{safe_filename}'")
-                            filename = safe_filename
-                            
-                        # 如果文件名变成了空字符串或只有下划线，使用时间戳作为名称
-                        if not filename.strip('_'):
-                            timestamp = int(time.time())
-                            filename = f"chinese_filename_{timestamp}.pdf"
-                            logger.info(f"使用时间戳替代空文件名: {filename}")
-                    except Exception as e:
-                        logger.warning(f"处理文件名时出错: {str(e)}，使用替代名称")
-                        timestamp = int(time.time())
-                        filename = f"filename_{timestamp}.pdf"
-                    
-                    # 确保文件名以.pdf结尾
-                    if not filename.lower().endswith('.pdf'):
-                        filename += '.pdf'
-                    
-                    # 文件保存路径
-                    file_path = os.path.join(self.temp_dir, filename)
-                    logger.info(f"准备保存文件到: {file_path}")
-                    
-                    # 尝试不同的方法读取文件内容
-                    file_content = None
-                    
-                    # 检查文件对象并打印详细信息
-                    logger.info(f"文件对象详情: {dir(file_obj)}")
-                    
+                yield {"status": "失败", "message": str(e)}
+                return
+            
+            total = len(files)
+            staged = []
+            # 并发保存文件，每保存完一个就报告一次进度
+            tasks = [asyncio.create_task(self._stage_upload(file_obj)) for file_obj in files]
+            ingest = None
+            try:
+                for done, future in enumerate(asyncio.as_completed(tasks), 1):
                     try:
-                        if hasattr(file_obj, 'read'):
-                            # 传统方式 - 直接读取
-                            file_content = file_obj.read()
-                            logger.info("使用 .read() 方法读取文件内容")
-                        elif isinstance(file_obj, tuple) and len(file_obj) > 0:
-                            # Gradio 4.x 方式 - 元组的第一个元素是文件路径
-                            src_path = file_obj[0]
-                            logger.info(f"从元组获取文件路径: {src_path}")
-                            with open(src_path, 'rb') as f:
-                                file_content = f.read()
-                        elif isinstance(file_obj, dict) and 'path' in file_obj:
-                            # 另一种可能的方式 - 字典中包含路径
-                            src_path = file_obj['path']
-                            logger.info(f"从字典获取文件路径: {src_path}")
-                            with open(src_path, 'rb') as f:
-                                file_content = f.read()
-                        elif isinstance(file_obj, str):
-                            # 字符串可能是文件路径
-                            logger.info(f"字符串作为文件路径: {file_obj}")
-                            with open(file_obj, 'rb') as f:
-                                file_content = f.read()
-                        elif hasattr(file_obj, '__str__'):
-                            # Gradio 4.x NamedString 类型 - 尝试获取字符串值
-                            try:
-                                # 针对 NamedString 类型的特殊处理
-                                if 'NamedString' in str(type(file_obj)):
-                                    logger.info("检测到 NamedString 类型")
-                                    # 通常 NamedString 在 Gradio 4.x 用于从本地上传的文件
-                                    # 在这种情况下，file_obj 实际上是一个模拟文件的对象
-                                    # value 属性通常包含临时文件路径
-                                    if hasattr(file_obj, 'value') and file_obj.value:
-                                        logger.info(f"从 NamedString.value 获取内容: {file_obj.value}")
-                                        if os.path.exists(file_obj.value):
-                                            with open(file_obj.value, 'rb') as f:
-                                                file_content = f.read()
-                                        else:
-                                            # 如果不是文件路径，可能是内容本身
-                                            file_content = file_obj.value.encode('utf-8')
-                                    elif str(file_obj):
-                                        # 尝试将对象转换为字符串，可能是文件内容
-                                        logger.info("将NamedString对象转换为字符串")
-                                        file_content = str(file_obj).encode('utf-8')
-                            except Exception as e:
-                                logger.error(f"处理NamedString时出错: {str(e)}")
-                                raise
-                        
-                        if file_content is None:
-                            logger.warning(f"无法读取文件内容，尝试其他方法")
-                            # 尝试直接使用文件对象的字符串表示
-                            file_content = str(file_obj).encode('utf-8')
+                        file_path = await future
                     except Exception as e:
-                        logger.error(f"读取文件内容时出错: {str(e)}")
-                        raise
-                    
-                    # 保存文件内容
-                    with open(file_path, "wb") as f:
-                        f.write(file_content)
-                    
-                    logger.info(f"成功保存文件: {file_path}")
-                    file_paths.append(file_path)
-                    
-                    # 打印文件路径
-                    logger.info(f"上传文件已保存至: {file_path}")
-                    print(f"上传文件已保存至: {file_path}")
-                    
-                    # 确保知识库仍然可用
-                    if not self.knowledge_base:
-                        logger.error("知识库在处理过程中变为None，尝试重新初始化")
-                        print("知识库在处理过程中变为None，尝试重新初始化")
-                        self.initialize_knowledge_base()
-                        
-                        if not self.knowledge_base:
-                            logger.error("重新初始化知识库失败，跳过添加文档步骤")
-                            print("重新初始化知识库失败，跳过添加文档步骤")
-                            continue
-                    
-                    # 添加文档到知识库
-                    logger.info(f"正在向知识库添加文档: {file_path}")
-                    print(f"正在向知识库添加文档: {file_path}")
-                    self.knowledge_base.add_pdf_document(file_path)
-                    logger.info("文档添加成功")
-                    print("文档添加成功")
+                        logger.error(f"处理文件时出错: {str(e)}")
+                    else:
+                        if file_path:
+                            staged.append(file_path)
+                    yield {"status": "进行中", "message": f"已保存 {done}/{total} 个文件"}
+                
+                if not staged:
+                    yield {"status": "失败", "message": "所有文件处理都失败了"}
+                    return
                 
-                except Exception as e:
-                    logger.error(f"处理文件时出错: {str(e)}")
-                    print(f"处理文件时出错: {str(e)}")
-                    continue
+                # 所有文件一起入库，分块后的节点合并批量计算嵌入并写入
+                logger.info(f"正在向知识库添加 {len(staged)} 个文档")
+                yield {"status": "进行中", "message": f"正在向知识库添加 {len(staged)} 个文档"}
+                # 客户端断开时入库线程无法中止，用shield保证入库结束前不会删除它正在读取的暂存文件
+                ingest = asyncio.ensure_future(asyncio.to_thread(kb.add_pdf_documents, staged))
+                file_paths = await asyncio.shield(ingest)
+                self._bump_kb_version()
+                logger.info("文档添加成功")
+            finally:
+                # 客户端断开等原因提前结束时，取消仍在保存的文件，被取消的任务会自行删除暂存目录
+                for task in tasks:
+                    task.cancel()
+                results = await asyncio.gather(*tasks, return_exceptions=True)
+                staging_dirs = [os.path.dirname(file_path) for file_path in results if isinstance(file_path, str)]
+                if ingest is not None and not ingest.done():
+                    # 入库仍在进行，结束后再删除暂存文件
+                    ingest.add_done_callback(lambda future: self._finish_detached_ingest(future, staging_dirs))
+                else:
+                    # 文件已入库（或处理失败），删除所有已保存的暂存文件
+                    self._remove_staging_dirs(staging_dirs)
             
             if not file_paths:
-                return {"status": "失败", "message": "所有文件处理都失败了"}
+                yield {"status": "失败", "message": "所有文件处理都失败了"}
+                return
             
-            # 确保知识库仍然可用
-            if not self.knowledge_base:
-                logger.error("知识库在处理完文件后变为None，无法获取状态")
-                return {"status": "部分成功", "message": f"成功上传 {len(file_paths)} 个文件，但无法获取知识库状态"}
-            
-            try:
-                status = self.knowledge_base.get_status()
-                return {
-                    "status": "成功", 
-                    "message": f"成功上传 {len(file_paths)} 个文件，知识库现有 {status['document_count']} 个文档"
-                }
-            except Exception as e:
-                logger.error(f"获取知识库状态失败: {str(e)}")
-                return {
-                    "status": "部分成功", 
-                    "message": f"成功上传 {len(file_paths)} 个文件，但获取知识库状态失败: {str(e)}"
-                }
+            count = kb.fast_count()
+            yield {
+                "status": "成功", 
+                "message": f"成功上传 {len(file_paths)} 个文件，知识库现有 {count} 个文档"
+            }
         except Exception as e:
             logger.error(f"上传PDF文件失败: {str(e)}")
-            return {"status": "失败", "message": f"上传PDF文件失败: {str(e)}"}
+            yield {"status": "失败", "message": f"上传PDF文件失败: {str(e)}"}
+    
+    @staticmethod
+    def _remove_staging_dirs(staging_dirs: List[str]) -> None:
+        """
+        删除上传文件的暂存目录
+        
+        Args:
+            staging_dirs: 暂存目录列表
+        """
+        for staging_dir in staging_dirs:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+    
+    def _finish_detached_ingest(self, ingest: "asyncio.Future", staging_dirs: List[str]) -> None:
+        """
+        客户端断开后仍在进行的入库结束时调用：删除暂存文件，入库成功时更新知识库版本号
+        
+        Args:
+            ingest: 入库任务
+            staging_dirs: 暂存目录列表
+        """
+        self._remove_staging_dirs(staging_dirs)
+        if ingest.cancelled():
+            return
+        if ingest.exception() is not None:
+            logger.error(f"上传PDF文件失败: {str(ingest.exception())}")
+        else:
+            self._bump_kb_version()
+    
+    def _ensure_default_executor(self) -> None:
+        """将当前事件循环的默认线程池替换为大小可配置的线程池，asyncio.to_thread会使用该线程池"""
+        loop = asyncio.get_running_loop()
+        if self._executor_loop is loop:
+            return
+        loop.set_default_executor(self.executor)
+        self._executor_loop = loop
     
-    def process_directory(self, dir_path: str) -> Dict[str, Any]:
+    @staticmethod
+    def _resolve_upload(file_obj: Any) -> Tuple[Optional[str], Optional[str]]:
+        """
+        获取上传文件在服务器上的路径和原始文件名（兼容不同版本的Gradio）
+        
+        Args:
+            file_obj: 上传的文件对象
+            
+        Returns:
+            （源文件路径, 文件名），无法获取时对应项为None
+        """
+        reader = _UPLOAD_READERS.get(type(file_obj)) or _read_fallback
+        return reader(file_obj)
+    
+    @staticmethod
+    def _stage_file(src_path: str, file_path: str) -> None:
+        """
+        将上传的文件保存到目标路径：优先创建硬链接，跨文件系统时在内核中用sendfile复制，
+        都不可用时按COPY_CHUNK_SIZE分块复制，内存占用不随文件大小增长
+        
+        Args:
+            src_path: 源文件路径
+            file_path: 目标文件路径
+        """
+        try:
+            os.link(src_path, file_path)
+            return
+        except OSError:
+            pass
+        
+        with open(src_path, 'rb') as src, open(file_path, 'wb') as dst:
+            if sys.platform.startswith("linux"):
+                try:
+                    size = os.fstat(src.fileno()).st_size
+                    offset = 0
+                    while offset < size:
+                        sent = os.sendfile(dst.fileno(), src.fileno(), offset, size - offset)
+                        if sent == 0:
+                            break
+                        offset += sent
+                    return
+                except OSError:
+                    # 部分文件系统不支持sendfile，清空目标文件后改为分块复制
+                    dst.seek(0)
+                    dst.truncate()
+            
+            shutil.copyfileobj(src, dst, length=COPY_CHUNK_SIZE)
+    
+    @staticmethod
+    def _is_pdf(src_path: str) -> bool:
+        """
+        根据文件开头的魔数判断是否为PDF文件
+        
+        Args:
+            src_path: 文件路径
+            
+        Returns:
+            是否为PDF文件
+        """
+        with open(src_path, 'rb') as f:
+            return f.read(len(PDF_MAGIC)) == PDF_MAGIC
+    
+    async def _stage_upload(self, file_obj: Any) -> Optional[str]:
+        """
+        将单个上传文件保存到暂存目录
+        
+        Args:
+            file_obj: 上传的文件对象
+            
+        Returns:
+            保存后的文件路径，不是PDF文件时返回None
+        """
+        # 记录文件对象类型，帮助调试
+        logger.debug(f"文件对象类型: {type(file_obj)}")
+        
+        # 获取上传文件在服务器上的路径和文件名
+        src_path, filename = self._resolve_upload(file_obj)
+        if not src_path or not os.path.isfile(src_path):
+            raise ValueError(f"无法获取上传文件的路径: {type(file_obj)}")
+        logger.debug(f"上传文件的源路径: {src_path}，文件名: {filename}")
+        
+        # 复制文件前先检查内容，非PDF文件直接跳过
+        if not await asyncio.to_thread(self._is_pdf, src_path):
+            logger.warning(f"上传的文件不是PDF，已跳过: {filename or src_path}")
+            return None
+        
+        if not filename:
+            # 如果无法获取文件名，生成一个随机文件名
+            timestamp = int(time.time())
+            filename = f"uploaded_file_{timestamp}.pdf"
+            logger.debug(f"使用生成的文件名: {filename}")
+        
+        # 处理中文文件名：确保能够正确编码
+        try:
+            # 尝试使用纯ASCII文件名（替换或删除非ASCII字符）
+            safe_filename = filename.encode('ascii', 'replace').decode('ascii').replace('?', '_')
+            if safe_filename != filename:
+                logger.debug(f"将中文文件名 '{filename}' 转换为安全文件名 '{safe_filename}'")
+                filename = safe_filename
+                
+            # 如果文件名变成了空字符串或只有下划线，使用时间戳作为名称
+            if not filename.strip('_'):
+                timestamp = int(time.time())
+                filename = f"chinese_filename_{timestamp}.pdf"
+                logger.debug(f"使用时间戳替代空文件名: {filename}")
+        except Exception as e:
+            logger.warning(f"处理文件名时出错: {str(e)}，使用替代名称")
+            timestamp = int(time.time())
+            filename = f"filename_{timestamp}.pdf"
+        
+        # 确保文件名以.pdf结尾
+        if not filename.lower().endswith('.pdf'):
+            filename += '.pdf'
+        
+        # 文件保存路径；多个文件并发保存，每个文件使用独立的子目录，避免同名文件互相覆盖
+        staging_dir = tempfile.mkdtemp(dir=self.temp_dir)
+        file_path = os.path.join(staging_dir, os.path.basename(filename))
+        logger.debug(f"准备保存文件到: {file_path}")
+        
+        # 检查文件对象并记录详细信息，dir()开销较大，仅在DEBUG级别下执行
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"文件对象详情: {dir(file_obj)}")
+        
+        try:
+            # 保存文件，不经过用户态读写
+            await asyncio.to_thread(self._stage_file, src_path, file_path)
+        except BaseException:
+            # 包括任务被取消（CancelledError不是Exception的子类）
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            raise
+        
+        logger.debug(f"上传文件已保存至: {file_path}")
+        return file_path
+    
+    async def process_directory(self, dir_path: str) -> Dict[str, Any]:
         """
         处理目录中的PDF文件
         
@@ -266,13 +410,14 @@ class GradioInterface:
             return {"status": "失败", "message": "未指定目录路径"}
             
         try:
-            if not self.knowledge_base:
-                self.initialize_knowledge_base()
+            self._ensure_default_executor()
+            kb = await asyncio.to_thread(self._get_kb)
                 
             # 添加目录中的文档到知识库
-            self.knowledge_base.add_pdf_documents_from_dir(dir_path)
+            await asyncio.to_thread(kb.add_pdf_documents_from_dir, dir_path)
+            self._bump_kb_version()
             
-            status = self.knowledge_base.get_status()
+            status = await asyncio.to_thread(kb.get_status)
             return {
                 "status": "成功", 
                 "message": f"成功处理目录 {dir_path}，知识库现有 {status['document_count']} 个文档"
@@ -281,7 +426,7 @@ class GradioInterface:
             logger.error(f"处理目录失败: {str(e)}")
             return {"status": "失败", "message": f"处理目录失败: {str(e)}"}
     
-    def query_knowledge_base(self, query: str) -> Tuple[str, str]:
+    async def query_knowledge_base(self, query: str) -> Tuple[str, str]:
         """
         查询知识库
         
@@ -295,34 +440,90 @@ class GradioInterface:
             return "请输入有效的查询", ""
             
         try:
-            if not self.knowledge_base:
-                return "知识库尚未初始化，请先上传PDF文档", ""
+            self._ensure_default_executor()
+            kb = await asyncio.to_thread(self._get_kb)
+            
+            # 相同的问题且知识库未变化时直接返回缓存的结果
+            cache_key = normalize_query(query)
+            version = self._kb_version
+            cached = self._get_cached_result(cache_key, version)
+            if cached is not None:
+                return cached
                 
-            # 查询知识库
-            result = self.knowledge_base.query(query)
+            # 查询知识库（在线程池中执行，不阻塞事件循环上的其他请求）
+            result = await asyncio.to_thread(kb.query, query)
             
             # 获取回答
             response = result.get("response", "")
             
             # 格式化引用
-            citations = result.get("citations", [])
+            contents = result.get("contents", [])
+            metadatas = result.get("metadatas", [])
             formatted_citations = ""
             
-            if citations:
-                formatted_citations = "## 引用来源\n\n"
-                for i, citation in enumerate(citations):
-                    metadata = citation.get("metadata", {})
-                    file_name = metadata.get("file_name", "未知文件")
-                    
-                    formatted_citations += f"### 引用 {i+1}（来自 {file_name}）\n\n"
-                    formatted_citations += f"```\n{citation.get('content', '')}\n```\n\n"
+            if contents:
+                # 先收集各段再一次性拼接，避免循环中反复拼接字符串
+                parts = ["## 引用来源\n\n"]
+                for i, (content, metadata) in enumerate(zip(contents, metadatas)):
+                    file_name = (metadata or {}).get("file_name", "未知文件")
+                    parts.append(f"### 引用 {i+1}（来自 {file_name}）\n\n```\n{content}\n```\n\n")
+                formatted_citations = "".join(parts)
             
+            # 查询出错时返回的是提示信息，不写入缓存，下次提问时重新查询
+            if not result.get("error"):
+                self._put_cached_result(cache_key, version, response, formatted_citations)
             return response, formatted_citations
         except Exception as e:
             logger.error(f"查询知识库失败: {str(e)}")
             return f"查询失败: {str(e)}", ""
     
-    def clear_knowledge_base(self) -> Dict[str, Any]:
+    def _bump_kb_version(self) -> None:
+        """知识库内容变化后递增版本号并清空查询结果缓存"""
+        with self._query_cache_lock:
+            self._kb_version += 1
+            self._query_cache.clear()
+    
+    def _get_cached_result(self, key: str, version: int) -> Optional[Tuple[str, str]]:
+        """
+        从查询结果缓存中查找结果，版本号不一致的结果视为未命中
+        
+        Args:
+            key: 规范化后的查询
+            version: 当前知识库版本号
+            
+        Returns:
+            （回答, 引用），未命中时返回None
+        """
+        with self._query_cache_lock:
+            entry = self._query_cache.get(key)
+            if entry is None:
+                return None
+            if entry[0] != version:
+                del self._query_cache[key]
+                return None
+            self._query_cache.move_to_end(key)
+            return entry[1], entry[2]
+    
+    def _put_cached_result(self, key: str, version: int, response: str, citations: str) -> None:
+        """
+        写入查询结果缓存，超出容量时淘汰最久未使用的结果
+        
+        Args:
+            key: 规范化后的查询
+            version: 查询开始时的知识库版本号
+            response: 回答
+            citations: 格式化后的引用
+        """
+        with self._query_cache_lock:
+            # 查询期间知识库已变化，结果可能过期，不写入缓存
+            if version != self._kb_version:
+                return
+            self._query_cache[key] = (version, response, citations)
+            self._query_cache.move_to_end(key)
+            while len(self._query_cache) > config.QUERY_RESULT_CACHE_SIZE:
+                self._query_cache.popitem(last=False)
+    
+    async def clear_knowledge_base(self) -> Dict[str, Any]:
         """
         清空知识库
         
@@ -330,10 +531,10 @@ class GradioInterface:
             处理结果信息
         """
         try:
-            if not self.knowledge_base:
-                return {"status": "成功", "message": "知识库尚未初始化"}
-                
-            self.knowledge_base.clear_knowledge_base()
+            self._ensure_default_executor()
+            kb = await asyncio.to_thread(self._get_kb)
+            await asyncio.to_thread(kb.clear_knowledge_base)
+            self._bump_kb_version()
             return {"status": "成功", "message": "知识库已清空"}
         except Exception as e:
             logger.error(f"清空知识库失败: {str(e)}")
@@ -346,10 +547,12 @@ class GradioInterface:
         Returns:
             Gradio界面对象
         """
+        model, embed = config.OPENAI_MODEL_NAME, config.OPENAI_EMBEDDING_MODEL_NAME
+        
         with gr.Blocks(title="PDF知识库RAG应用") as interface:
             gr.Markdown("# PDF知识库RAG应用")
             gr.Markdown("基于OpenAI LLM的PDF文档检索增强生成（RAG）系统，提供智能问答服务")
-            gr.Markdown(f"使用模型: **{Config.OPENAI_MODEL_NAME}** | 嵌入模型: **{Config.OPENAI_EMBEDDING_MODEL_NAME}**")
+            gr.Markdown(f"使用模型: **{model}** | 嵌入模型: **{embed}**")
             
             with gr.Tab("文档管理"):
                 with gr.Row():
@@ -422,26 +625,39 @@ class GradioInterface:
             server_host: 服务主机
         """
         interface = self.create_gradio_interface()
+        # 进程退出时关闭共用的HTTP客户端
+        atexit.register(self._http.close)
         
-        port = server_port or Config.APP_PORT
-        host = server_host or Config.APP_HOST
+        port = server_port or config.APP_PORT
+        host = server_host or config.APP_HOST
+        share = config.GRADIO_SHARE
+        max_threads = config.THREAD_POOL_SIZE
         
         logger.info(f"启动Gradio服务，地址: {host}:{port}")
         
+        # 始终启用请求队列，查询和上传可以并发处理，互不阻塞
+        # Gradio 4.x 中concurrency_count已被移除，改用default_concurrency_limit
+        interface.queue(
+            default_concurrency_limit=config.GRADIO_CONCURRENCY,
+            max_size=config.GRADIO_QUEUE_MAX
+        )
+        
         # 使用更简单的方式启动Gradio，避免与FastAPI和Pydantic的冲突
         try:
             # 方式1：最简单的启动方式
             interface.launch(
                 server_name=host,
                 server_port=port,
-                share=True
+                share=share,
+                max_threads=max_threads
             )
         except Exception as e:
             logger.error(f"Gradio服务启动失败: {str(e)}")
             # 方式2：备用启动方式
             logger.info("尝试使用备用设置启动...")
             gr.close_all()
-            interface.queue(concurrency_count=1).launch(
+            interface.launch(
                 server_port=port,
-                share=True
+                share=share,
+                max_threads=max_threads
             ) 
\ No newline at end of file